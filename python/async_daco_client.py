@@ -0,0 +1,129 @@
+import asyncio
+
+from format_errors import err_msg
+from journal import CREATE
+from sync_plan import DACO, CLOUD, make_plan
+
+
+class AsyncDacoClient(object):
+    """
+    Drives a sync with an AsyncEgoClient: it plans the changes from one
+    snapshot of ego, like DacoClient.sync(), then makes all of them at
+    once, leaving the async ego client to limit how many are in flight.
+    """
+
+    def __init__(self, daco_client, ego_client):
+        """
+        :param daco_client: The DacoClient with the users to sync, which
+            also keeps our counts
+        :param ego_client: An AsyncEgoClient
+        """
+        self.daco_client = daco_client
+        self.ego_client = ego_client
+        self.daco_group = daco_client.daco_group
+        self.cloud_group = daco_client.cloud_group
+        self._operations = {
+            ('add', DACO): (self.daco_group, "grant DACO access",
+                            "Can't grant daco access to user '{}'"),
+            ('add', CLOUD): (self.cloud_group, "grant cloud access",
+                             "Can't grant cloud access to user '{}'"),
+            ('remove', DACO): (self.daco_group, "revoke DACO access",
+                               "Can't revoke daco access for user '{}'"),
+            ('remove', CLOUD): (self.cloud_group, "revoke cloud access",
+                                "Can't revoke cloud access for user '{}'"),
+        }
+
+    def count(self, category, err=False):
+        self.daco_client.count(category, err)
+
+    def get_summary(self):
+        return self.daco_client.get_summary()
+
+    async def sync(self):
+        """ Handles the same scenarios as DacoClient.sync()
+
+            returns: A list of issues encountered
+        """
+        metrics = self.daco_client.metrics
+        try:
+            with metrics.phase('download'):
+                plan = await self.plan()
+        except LookupError as e:
+            self.count("get the state of ego", err=True)
+            return [err_msg(e.args[0], e.args[1])]
+        with metrics.phase('apply'):
+            return await self.apply(plan)
+
+    async def plan(self):
+        try:
+            ego_users, daco_users, cloud_users = await asyncio.gather(
+                self.ego_client.all_users(),
+                self.ego_client.get_users(self.daco_group),
+                self.ego_client.get_users(self.cloud_group))
+        except Exception as e:
+            raise LookupError("Can't get the current state of ego", e)
+        return make_plan(self.daco_client.approved_users(), ego_users,
+                         self.daco_client.in_shard(daco_users), self.daco_client.in_shard(cloud_users))
+
+    async def apply(self, plan):
+        """ Make the changes in the plan, all at once, except that the
+            changes for one user are made one after another, in plan
+            order: a plan can grant a user a group and later revoke it.
+        """
+        by_user = {}
+        for change in plan:
+            by_user.setdefault(change.user.email, []).append(change)
+        issues = {}
+
+        async def apply_in_order(changes):
+            for change in changes:
+                issues[change] = await self.apply_change(change)
+
+        await asyncio.gather(*map(apply_in_order, by_user.values()))
+        return list(filter(None, (issues[change] for change in plan)))
+
+    async def apply_change(self, change):
+        try:
+            if change.create:
+                await self.create_user(change.user)
+            for group in change.add:
+                await self.change_group('add', group, change.user)
+            for group in change.remove:
+                await self.change_group('remove', group, change.user)
+        except LookupError as e:
+            return err_msg(e.args[0], e.args[1])
+        self.count(change.category)
+        return change.message
+
+    async def journaled(self, op, group, emails, call):
+        """ Like DacoClient.journaled, for a call that returns a coroutine """
+        journal = self.daco_client.journal
+        if journal is None:
+            return await call()
+        with journal.record(op, group, emails) as outcome:
+            reply = await call()
+            if isinstance(reply, dict) and reply.get('id'):
+                outcome['ego_id'] = reply['id']
+            return reply
+
+    async def create_user(self, user, msg=None):
+        if msg is None:
+            msg = f"Can't create user '{user}'"
+        try:
+            ego_id = self.daco_client.created_earlier(user)
+            if ego_id is not None:
+                return await self.ego_client.remember_user(user.email, ego_id)
+            return await self.journaled(CREATE, None, [user.email],
+                                        lambda: self.ego_client.create_user(user.email, user.name))
+        except Exception as e:
+            self.count('create user', err=True)
+            raise LookupError(msg, e)
+
+    async def change_group(self, action, group, user):
+        ego_group, category, msg = self._operations[(action, group)]
+        try:
+            await self.journaled(action, ego_group, [user.email],
+                                 lambda: getattr(self.ego_client, action)(ego_group, [user.email]))
+        except Exception as e:
+            self.count(category, err=True)
+            raise LookupError(msg.format(user), e)
@@ -0,0 +1,69 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncClient(object):
+    """
+    Runs the methods of a blocking rest client on a thread pool, so that
+    coroutines can keep up to concurrency requests in flight at once: the
+    pool's threads are the only limit.
+
+    The wrapped client's Transport already makes sure that any number of
+    requests that see the same expiring token share one token refresh.
+    """
+
+    def __init__(self, client, concurrency=100):
+        self.client = client
+        self.concurrency = concurrency
+        self._executor = ThreadPoolExecutor(concurrency)
+
+    async def _call(self, method, *args, **kwargs):
+        f = functools.partial(getattr(self.client, method), *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, f)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+
+class AsyncEgoClient(AsyncClient):
+    """ The EgoClient api, as coroutines """
+
+    async def all_users(self):
+        return await self._call('all_users')
+
+    async def load_users(self):
+        return await self._call('load_users')
+
+    async def get_users(self, group):
+        return await self._call('get_users', group)
+
+    async def is_member(self, group, user):
+        return await self._call('is_member', group, user)
+
+    async def user_exists(self, user):
+        return await self._call('user_exists', user)
+
+    async def create_user(self, user, name, ego_type="USER"):
+        return await self._call('create_user', user, name, ego_type)
+
+    async def remember_user(self, user, user_id):
+        return await self._call('remember_user', user, user_id)
+
+    async def add(self, group, users):
+        return await self._call('add', group, users)
+
+    async def remove(self, group, users):
+        return await self._call('remove', group, users)
+
+    async def refresh(self, group):
+        return await self._call('refresh', group)
+
+    def invalidate(self, group=None):
+        return self.client.invalidate(group)
+
+    def read_latency(self):
+        return self.client.read_latency()
+
+    def cache_stats(self):
+        return self.client.cache_stats()
@@ -1,21 +1,30 @@
 #!/usr/bin/env python3
 
+import argparse
+import asyncio
 import csv
 import json
 import sys
 import logging
 
-from oauthlib.oauth2 import BackendApplicationClient
-from requests.auth import HTTPBasicAuth
-from requests_oauthlib import OAuth2Session
-
+from async_daco_client import AsyncDacoClient
+from async_ego_client import AsyncEgoClient
 from daco_client import DacoClient
-from daco_user import User
+from daco_user import User, normalize_email
+from ego_cache import GroupIdCache
 from ego_client import EgoClient
 from format_errors import err_msg
-from report import create as create_report
+from journal import Journal
+from metrics import Metrics
+from profiling import profile
+from report import create as create_report, create_plan as create_plan_report
+from shards import Shard, merge_results, save_result
 from slack import Reporter as SlackReporter
+from state_store import StateStore, sync_incremental
 from daco_v2_ego_client import DacoV2EgoClient
+from rate_limit import AdaptiveLimiter
+from token_cache import TokenCache
+from transport import Transport
 
 
 def read_config(name="config/default.conf"):
@@ -23,17 +32,21 @@ def read_config(name="config/default.conf"):
         conf = json.load(f)
     return conf
 
-def daco_users_csv_to_list(data):
-    ret_list = []
-    reader = csv.DictReader(data.splitlines())
-
-    for user in reader:
-        print(f'DACO 2 user:', user)
-        openid = user['OPENID'].lower()
+def daco_users_from_csv(lines):
+    """
+    Parse the approved users export one line at a time
+    :param lines: An iterable of the lines of the export
+    :return: A generator of User objects
+    """
+    for user in csv.DictReader(lines):
+        logging.debug(f'DACO 2 user: {user}')
+        openid = normalize_email(user['OPENID'])
         user_name = user['USER NAME']
-        ret_list.append(User(openid,user_name,True,True))
+        yield User(openid, user_name, True, True)
 
-    return ret_list
+
+def daco_users_csv_to_list(data):
+    return list(daco_users_from_csv(data.splitlines()))
 
 
 def is_member(members, candidate):
@@ -48,15 +61,38 @@ def send_report(issues, summary):
     print("* End of report *")
 
 
-def get_oauth_authenticated_client(base_url, client_id, client_secret):
-    auth = HTTPBasicAuth(client_id, client_secret)
-    client = BackendApplicationClient(client_id=client_id)
-    oauth = OAuth2Session(client=client)
-    oauth.fetch_token(token_url=base_url + '/oauth/token', auth=auth)
-    return oauth
+def get_oauth_authenticated_client(transport, base_url, client_id, client_secret):
+    auth = transport.client_credentials(base_url + '/oauth/token', client_id, client_secret)
+    return transport.client(auth)
+
+
+def make_transport(config):
+    """
+    One pool of connections, big enough for as many requests as we'll make at once.
+    init() adds the token cache, so that a mistake in its settings is reported
+    with the other configuration errors.
+    """
+    client = config.get('client', {})
+    concurrency = max(client.get('workers', 1), client.get('page_workers', 4),
+                      client.get('async_concurrency') or 1)
+    limiter = AdaptiveLimiter(concurrency + 2, target_latency=client.get('target_latency'))
+    return Transport(pool_size=concurrency + 2, timeout=client.get('timeout', 60),
+                     refresh_margin=client.get('token_refresh_margin', 60),
+                     limiter=limiter, retries=client.get('retries', 3))
 
 
-def init(config):
+def make_token_cache(config):
+    """ :return: The TokenCache to share ego tokens through, if the config sets one up """
+    if not config['client'].get('token_cache_file'):
+        return None
+    return TokenCache(config['client']['token_cache_file'], config['client']['token_cache_secret'])
+
+
+def init(config, transport=None, shard=None, journal=None):
+    if transport is None:
+        transport = make_transport(config)
+    transport.token_cache = make_token_cache(config)
+
     client_id = config['client']['client_id']
     client_secret = config['client']['client_secret']
     base_url = config['client']['base_url']
@@ -66,21 +102,35 @@ def init(config):
     daco_v2_client_secret = config['daco_v2_client']['client_secret']
     dac_api_url = config['daco_v2_client']['dac_api_url']
 
-    rest_client = get_oauth_authenticated_client(base_url, client_id, client_secret)
-    ego_client = EgoClient(base_url, rest_client,  # Want to create a factory for new oauth clients
-                           lambda: get_oauth_authenticated_client(base_url, client_id, client_secret))
+    # Every client records its requests in one place, for the report
+    metrics = Metrics()
+
+    # Expired tokens are refreshed in place, keeping the connections we've got open
+    rest_client = get_oauth_authenticated_client(transport, base_url, client_id, client_secret)
+    ego_client = EgoClient(base_url, rest_client, rest_client.refreshed, metrics=metrics,
+                           page_size=config['client'].get('page_size', 1000),
+                           page_workers=config['client'].get('page_workers', 4),
+                           hashed_members=config['client'].get('hashed_members', False),
+                           group_ids=GroupIdCache(config['client'].get('group_cache_ttl', 86400),
+                                                  config['client'].get('group_cache_file')))
+    if config['client'].get('preload_users', False):
+        logging.info(f"Indexed {ego_client.load_users()} ego users.")
 
     # create second rest and ego client to access permissions for dac-api in argo ego
-    daco_v2_rest_client = get_oauth_authenticated_client(daco_v2_ego_url, daco_v2_client_id, daco_v2_client_secret)
-    daco_v2_ego_client = DacoV2EgoClient(daco_v2_ego_url, daco_v2_rest_client, dac_api_url,  # Want to create a factory for new oauth clients
-                            lambda: get_oauth_authenticated_client(daco_v2_ego_url, daco_v2_client_id, daco_v2_client_secret))
+    daco_v2_rest_client = get_oauth_authenticated_client(transport, daco_v2_ego_url, daco_v2_client_id,
+                                                         daco_v2_client_secret)
+    daco_v2_ego_client = DacoV2EgoClient(daco_v2_ego_url, daco_v2_rest_client, dac_api_url,
+                                         daco_v2_rest_client.refreshed, metrics)
 
-    approved_users = daco_v2_ego_client.download_approved_users()
-    approved_users_list = daco_users_csv_to_list(approved_users)
+    # Users are parsed as the export arrives, and DacoClient starts on them straight away
+    approved_users = daco_users_from_csv(daco_v2_ego_client.stream_approved_users())
 
     daco_group = config['client']['daco_group']
     cloud_group = config['client']['cloud_group']
-    daco_client = DacoClient(daco_group, cloud_group, approved_users_list, ego_client)
+    daco_client = DacoClient(daco_group, cloud_group, approved_users, ego_client,
+                             batch_size=config['client'].get('batch_size'),
+                             workers=config['client'].get('workers', 1),
+                             metrics=metrics, shard=shard, journal=journal)
 
     logging.info('Daco Client Initialized.');
     return daco_client
@@ -90,14 +140,169 @@ def logError(msg, e):
     print(f"*** Failed to send report: {err_msg(msg, e)} ***")
 
 
+def parse_args(args):
+    parser = argparse.ArgumentParser(prog="daco2ego.py",
+                                     description="Load the DACO approved users list into ego.")
+    parser.add_argument("config", nargs="?", default="config/default.conf",
+                        help="configuration file (default: %(default)s)")
+    parser.add_argument("--plan", action="store_true",
+                        help="show the changes ego needs, and estimate how long making them would take, "
+                             "without changing anything")
+    parser.add_argument("--full", action="store_true",
+                        help="check every user, even if we have the state of the last run (see state_file)")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip the changes in ego that a run which didn't finish has already made "
+                             "(see journal_file)")
+    parser.add_argument("--profile", action="store_true",
+                        help="run under cProfile and tracemalloc, saving the profile and the top "
+                             "allocation sites in --profile-dir")
+    parser.add_argument("--profile-dir", default="profile", metavar="DIR",
+                        help="where --profile saves what it finds (default: %(default)s)")
+    parser.add_argument("--sample", type=float, metavar="SECONDS",
+                        help="log the stack of every thread every SECONDS during the run")
+    shards = parser.add_mutually_exclusive_group()
+    shards.add_argument("--shard", type=shard_spec, metavar="I/N",
+                        help="only sync shard I (from 0) of N, saving the results for --merge "
+                             "instead of sending them to slack")
+    shards.add_argument("--merge", type=int, metavar="N",
+                        help="report the results of all N shards of a run as one")
+    return parser.parse_args(args)
+
+
+def shard_spec(spec):
+    try:
+        return Shard.parse(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def show_plan(daco_client, concurrency=None):
+    """
+    Print what a run would change in ego
+    :param concurrency: How many requests the run would make at once, if
+        not one per worker (e.g. with async_concurrency)
+    """
+    try:
+        plan = daco_client.plan()
+    except LookupError as e:
+        print(err_msg(e.args[0], e.args[1]))
+        return
+    except Exception as e:
+        # e.g. the export failed part way through
+        print(err_msg("Can't make a plan", e))
+        return
+    requests = plan.request_count(daco_client.batch_size)
+    print(create_plan_report(plan, requests, daco_client.ego_client.read_latency(),
+                             concurrency or daco_client.workers))
+
+
+def run_async(daco_client, concurrency):
+    ego_client = AsyncEgoClient(daco_client.ego_client, concurrency)
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(AsyncDacoClient(daco_client, ego_client).sync())
+    finally:
+        loop.close()
+        ego_client.close()
+
+
+def update(daco_client, config):
+    """ Bring ego up to date for every user, in the way the config asks for """
+    if config['client'].get('async_concurrency'):
+        return run_async(daco_client, config['client']['async_concurrency'])
+    elif config['client'].get('planner', False):
+        return daco_client.sync()
+    return daco_client.update_ego()
+
+
+def update_incremental(daco_client, config, full):
+    path = config['client']['state_file']
+    if daco_client.shard is not None:
+        path = daco_client.shard.path(path)
+    store = StateStore(path)
+    try:
+        return sync_incremental(daco_client, store, lambda: update(daco_client, config), full,
+                                config['client'].get('full_sync_interval', 7 * 86400))
+    finally:
+        store.close()
+
+
+def open_journal(config, shard=None, resume=False):
+    """ The journal to record the changes we make in ego in, if the config asks for one """
+    path = config['client']['journal_file'] if resume else config['client'].get('journal_file')
+    if path is None:
+        return None
+    if shard is not None:
+        path = shard.path(path)
+    journal = Journal(path, config['client'].get('journal_sync_every', 100))
+    skipped = journal.start(resume)
+    if resume:
+        logging.info(f"Resuming: skipping {skipped} changes made by the last run.")
+    return journal
+
+
+def save_metrics(path, daco_client, transport):
+    """ Save the phases and requests of a run as JSON, with every HTTP request (and retry) by host """
+    performance = daco_client.metrics.summary()
+    performance['http'] = transport.metrics.endpoints()
+    with open(path, 'w') as f:
+        json.dump(performance, f, indent=2, sort_keys=True)
+
+
+def finish_run(config, shard, daco_client, transport, journal, counts, errors):
+    """
+    Record the end of a run that changed ego. A failure here is logged,
+    but doesn't change what we report the run did.
+    :return: The performance summary to report, if the config asks for one
+    """
+    if journal is not None:
+        try:
+            journal.finish(counts, errors)
+        except Exception as e:
+            logError("Can't record the end of the run in the journal", e)
+    if config['client'].get('metrics_file'):
+        path = config['client']['metrics_file']
+        if shard is not None:
+            path = shard.path(path)
+        try:
+            save_metrics(path, daco_client, transport)
+        except Exception as e:
+            logError(f"Can't save metrics to '{path}'", e)
+    if config['client'].get('report_performance', False):
+        return daco_client.metrics.summary()
+    return None
+
+
+def shard_dir(config):
+    return config.get('client', {}).get('shard_dir', 'shards')
+
+
+def send_summary(slack_client, issues, summary):
+    try:
+        send_report(issues, summary)
+        slack_client.send(summary)
+    except Exception as e:
+        logError("Can't send out report", e)
+
+
+def configure_logging(options):
+    """ --profile and --sample log what they find at INFO, so make sure it's shown """
+    if options.profile or options.sample:
+        logging.basicConfig()  # unless logging is already set up
+        root = logging.getLogger()
+        if root.getEffectiveLevel() > logging.INFO:
+            root.setLevel(logging.INFO)
+
+
 def main(_program_name, *args):
     config = None
     slack_client = None
+    performance = None
+    journal = None
+    options = parse_args(args)
+    configure_logging(options)
     try:
-        if args:
-            config = read_config(args[0])
-        else:
-            config = read_config()
+        config = read_config(options.config)
     except FileNotFoundError as f:
         logError(f"Can't read configuration file '{f.filename}'", f)
         exit(2)  # ENOENT (No such file or directory)
@@ -107,44 +312,73 @@ def main(_program_name, *args):
 
     logging.info('Configuration Loaded.')
 
+    transport = make_transport(config)
     try:
-        slack_client = SlackReporter(config['slack']['url'])
+        slack_client = SlackReporter(config['slack']['url'], transport)
     except Exception as e:
         logError("Can't get slack client to report errors!", e)
         exit(6)  # ENXIO (No such device or address)
 
     logging.info('Slack webhook configured.')
 
-    try:
-        daco_client = init(config)
-    except KeyError as e:
-        issues = ["Daco2Ego configuration file error: missing entry for " + str(e)]
-        counts, errors = {}, issues
-        ran = False
-    except Exception as e:
-        # Scenario 5 (Start-up failed)
-        issues = ["DACO client init error:" + str(type(e)) + '(' + str(e) + ')']
-        counts, errors = {}, issues
-        ran = False
-    else:
-        # Scenarios 1,2,3,4,6
+    if options.merge:
+        counts, errors, issues, ran = merge_results(shard_dir(config), options.merge)
+        send_summary(slack_client, issues, create_report(counts, errors, ran))
+        return
+
+    # from the start, so the profile includes the downloads init() makes
+    with profile(options.profile_dir if options.profile else None, options.sample):
         try:
-            logging.info("Starting Ego Update...")
-            issues = daco_client.update_ego()
-            counts, errors = daco_client.get_summary()
-            ran = True
+            journal = None if options.plan else open_journal(config, options.shard, options.resume)
+            daco_client = init(config, transport, options.shard, journal)
+        except KeyError as e:
+            issues = ["Daco2Ego configuration file error: missing entry for " + str(e)]
+            counts, errors = {}, issues
+            ran = False
         except Exception as e:
-            issues = [err_msg("Run failed", e)]
+            # Scenario 5 (Start-up failed)
+            issues = ["DACO client init error:" + str(type(e)) + '(' + str(e) + ')']
             counts, errors = {}, issues
             ran = False
-
-    try:
-        summary = create_report(counts, errors, ran)
+        else:
+            if options.plan:
+                show_plan(daco_client, config['client'].get('async_concurrency'))
+                return
+
+            # Scenarios 1,2,3,4,6
+            try:
+                logging.info("Starting Ego Update...")
+                if config['client'].get('state_file'):
+                    issues = update_incremental(daco_client, config, options.full)
+                else:
+                    issues = update(daco_client, config)
+                counts, errors = daco_client.get_summary()
+                ran = True
+            except Exception as e:
+                issues = [err_msg("Run failed", e)]
+                counts, errors = {}, issues
+                ran = False
+            else:
+                logging.info(f"Ego membership cache: {daco_client.ego_client.cache_stats()}")
+                performance = finish_run(config, options.shard, daco_client, transport, journal,
+                                         counts, errors)
+    if options.plan:
+        # we couldn't start; a plan is only ever printed, never sent to slack
+        for issue in issues:
+            print(issue)
+        return
+    if journal is not None:
+        journal.close()
+
+    summary = create_report(counts, errors, ran, performance)
+    if options.shard is not None:
         send_report(issues, summary)
-        slack_client.send(summary)
-
-    except Exception as e:
-        logError("Can't send out report", e)
+        try:
+            save_result(shard_dir(config), options.shard, counts, errors, issues, ran)
+        except Exception as e:
+            logError(f"Can't save the results of shard {options.shard}", e)
+        return
+    send_summary(slack_client, issues, summary)
 
 
 if __name__ == "__main__":
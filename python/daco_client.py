@@ -1,39 +1,204 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 from format_errors import err_msg
-from daco_user import User
+from journal import CREATE
+from daco_user import User, email_key
+from metrics import Metrics
+from sync_plan import DACO, CLOUD, make_plan
+from validation import check, validate, warning
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
 
 class DacoClient(object):
-    def __init__(self, daco_group, cloud_group, users, ego_client):
+    def __init__(self, daco_group, cloud_group, users, ego_client,
+                 batch_size=None, workers=1, metrics=None, shard=None, journal=None):
         """
-        :param users: A list of User objects
+        :param users: A list of User objects, or an iterator that yields
+            them as they are read (e.g. while the export downloads)
 
         :param ego_client:
             An EgoClient object that applies the requested changes
             to the Ego server.
+
+        :param batch_size:
+            If set, apply() adds and removes up to this many users
+            per ego request, instead of one user at a time.
+
+        :param workers:
+            How many users to work on at the same time. The issues
+            we return are always in the same order as the users.
+
+        :param metrics:
+            The Metrics to record the time each phase of a run takes in.
+
+        :param shard:
+            If set, a shards.Shard: we only look after the users in it,
+            both the approved users and the ego users we might revoke.
+
+        :param journal:
+            If set, a journal.Journal to record every change we make
+            in ego in, and to find the users a run we're resuming created.
         """
         self.ego_client = ego_client
-        self.users = users
+        self.batch_size = batch_size
+        self.workers = workers
+        self.metrics = metrics if metrics is not None else Metrics()
         self.daco_group = daco_group
         self.cloud_group = cloud_group
+        self.shard = shard
+        self.journal = journal
+        if shard is not None:
+            users = shard.select(users)
+        if isinstance(users, (list, tuple)):
+            self.users, self._incoming = users, None
+        else:
+            self.users, self._incoming = [], users
         # make a map of ego id == user.email to user, so that we can
         # find ego users with daco permissions.
-        self._user_map = {u.email.lower(): u for u in users}
+        self._user_map = {u.key: u for u in self.users}
         self._counts = {}
+        self._counts_lock = threading.Lock()
 
     def update_ego(self):
         """ Handles documented scenarios
 
             returns: A list of issues encountered
         """
+        with self.metrics.phase('grant'):
+            issues = list(self.grant())
+        with self.metrics.phase('revoke'):
+            issues += list(self.revoke())
+        return issues
 
-        return (list(self.grant()) +
-                list(self.revoke()))
+    def sync(self):
+        """ Handles the same scenarios as update_ego, but decides what to
+            do from one snapshot of ego, then applies the plan.
 
-    def count(self, category, err=False):
+            returns: A list of issues encountered
+        """
         try:
-            self._counts[category][0] += 1
-        except KeyError:
-            self._counts[category] = [1, err]
+            with self.metrics.phase('download'):
+                plan = self.plan()
+        except LookupError as e:
+            self.count("get the state of ego", err=True)
+            return [err_msg(e.args[0], e.args[1])]
+        with self.metrics.phase('apply'):
+            return self.apply(plan)
+
+    def plan(self):
+        """ Compare the approved users with a snapshot of ego
+
+            returns: A Plan of the changes ego needs
+        """
+        try:
+            ego_users = self.ego_client.all_users()
+            daco_users = self.in_shard(self.ego_client.get_users(self.daco_group))
+            cloud_users = self.in_shard(self.ego_client.get_users(self.cloud_group))
+        except Exception as e:
+            raise LookupError("Can't get the current state of ego", e)
+        return make_plan(self.approved_users(), ego_users, daco_users, cloud_users)
+
+    def apply(self, plan):
+        """ Make the changes in the plan
+
+            returns: A list of issues encountered
+        """
+        if self.batch_size:
+            return self.apply_batched(plan)
+        return list(filter(None, self._map(self.apply_change, plan)))
+
+    def apply_batched(self, plan):
+        """ Make the changes in the plan, creating users one at a time,
+            then adding and removing them from each group in batches.
+
+            returns: A list of issues encountered
+        """
+        failed = {}  # change -> error message
+
+        for change in plan:
+            if change.create:
+                try:
+                    self.create_user(change.user)
+                except LookupError as e:
+                    failed[change] = err_msg(e.args[0], e.args[1])
+
+        steps = ((self.daco_group, 'add', DACO, self.grant_daco),
+                 (self.cloud_group, 'add', CLOUD, self.grant_cloud),
+                 (self.daco_group, 'remove', DACO, self.revoke_daco),
+                 (self.cloud_group, 'remove', CLOUD, self.revoke_cloud))
+
+        for group, action, name, single in steps:
+            changes = [c for c in plan
+                       if name in getattr(c, action) and c not in failed]
+            for batch in chunks(changes, self.batch_size):
+                failed.update(self.apply_batch(group, action, single, batch))
+
+        issues = []
+        for change in plan:
+            if change in failed:
+                issues.append(failed[change])
+            else:
+                self.count(change.category)
+                issues.append(change.message)
+        return issues
+
+    def apply_batch(self, group, action, single, batch):
+        """ Add or remove the users for a batch of changes with one
+            ego call. If the batch fails, fall back to one call per user,
+            so we know exactly which users failed.
+
+            returns: A dictionary of failed changes to error messages
+        """
+        try:
+            self.change_group(action, group, [c.user.email for c in batch])
+            return {}
+        except Exception:
+            pass
+
+        failed = {}
+        for change in batch:
+            try:
+                single(change.user)
+            except LookupError as e:
+                failed[change] = err_msg(e.args[0], e.args[1])
+        return failed
+
+    def apply_change(self, change):
+        grant = {DACO: self.grant_daco, CLOUD: self.grant_cloud}
+        revoke = {DACO: self.revoke_daco, CLOUD: self.revoke_cloud}
+        try:
+            if change.create:
+                self.create_user(change.user)
+            for group in change.add:
+                grant[group](change.user)
+            for group in change.remove:
+                revoke[group](change.user)
+        except LookupError as e:
+            return err_msg(e.args[0], e.args[1])
+        self.count(change.category)
+        return change.message
+
+    def count(self, category, err=False):
+        with self._counts_lock:
+            try:
+                self._counts[category][0] += 1
+            except KeyError:
+                self._counts[category] = [1, err]
+
+    def _map(self, f, items):
+        """ map f over items, on a pool of worker threads if we have more
+            than one worker. Results come back in the order of items.
+        """
+        if self.workers <= 1:
+            return map(f, items)
+        with ThreadPoolExecutor(self.workers) as pool:
+            return list(pool.map(f, items))
 
     def get_summary(self):
         counts = {k: v[0] for k, v in self._counts.items() if not v[1]}
@@ -41,38 +206,136 @@ class DacoClient(object):
         return counts, errors
 
     def grant(self):
-        return self.grant_users(self.users)
+        # If the export is still arriving, validate() reads the rest of it
+        # first: we can't tell an entry is superseded until we've seen them all.
+        rejects = self.validate()
+        return filter(None, self._map(lambda entry: self.grant_entry(rejects, *entry),
+                                      self.entries(rejects)))
 
-    def grant_users(self, users):
-        return filter(None, map(self.grant_user, users))
+    def validate(self):
+        """ Check every approved user, before we change anything in ego
 
-    def grant_user(self, user):
+            returns: The Rejects, by position in our list of users
+        """
+        rejects = validate(self.approved_users())
+        if rejects:
+            logging.info(f"Not granting access for {len(rejects)} entries: {rejects.counts()} "
+                         f"({rejects.duplicates} emails with multiple entries)")
+        return rejects
+
+    def entries(self, rejects):
+        """ The (position, user) entries of our list to work on: all of them,
+            except exact repeats of an entry we'll grant already. Those
+            would only be no-ops one at a time, but with several workers,
+            two copies could both find the user missing and both grant.
+        """
+        seen = set()
+        for position, user in enumerate(self.users):
+            if position not in rejects:
+                if email_key(user.email) in seen:
+                    continue
+                seen.add(email_key(user.email))
+            yield position, user
+
+    def grant_entry(self, rejects, position, user):
+        """ Grant access for the user at position in our list, if it passed validation """
+        if position in rejects:
+            return self.reject(user, rejects.reason(position))
         try:
-            return self.grant_access_if_necessary(user)
+            return self.grant_access(user)
         except LookupError as e:
             return err_msg(e.args[0], e.args[1])
 
+    def reject(self, user, reason):
+        self.count(reason)
+        return warning(user, reason)
+
+    def receive(self):
+        """ Read the rest of our input stream, adding the users to our
+            list of users and to the user map (where a later entry for an
+            email replaces an earlier one) as they arrive.
+        """
+        incoming, self._incoming = self._incoming, None
+        for user in incoming:
+            self.users.append(user)
+            self._user_map[user.key] = user
+
+    def approved_users(self):
+        """ The list of all the approved users, reading the rest of our
+            input stream first if there is one.
+        """
+        if self._incoming is not None:
+            self.receive()
+        return self.users
+
     def revoke(self):
         try:
             users = self.get_daco_users_from_ego()
         except Exception as e:
+            self.count("get daco users", err=True)
             return [err_msg("Can't get list of daco_users from ego", e)]
         return self.revoke_users(users)
 
+    def in_shard(self, emails):
+        """ The emails of the ego users that are ours to look after """
+        if self.shard is None:
+            return emails
+        return {e for e in emails if e in self.shard}
+
+    def latest_users(self):
+        """ A dictionary of email to the last entry for that email """
+        self.approved_users()
+        return {u.email: u for u in self._user_map.values()}
+
+    def group_sizes(self):
+        """ The number of users in the (daco, cloud) groups in ego """
+        return (self.ego_client.group_size(self.daco_group),
+                self.ego_client.group_size(self.cloud_group))
+
+    def update_ego_changes(self, previous):
+        """ Handles the documented scenarios for just the users whose
+            entries have changed since a previous run.
+
+            :param previous: A dictionary of email to User, of the approved
+                users as they were when we last brought ego up to date
+
+            returns: A list of issues encountered
+        """
+        with self.metrics.phase('download'):
+            self.approved_users()
+        rejects = self.validate()
+        latest = self.latest_users()
+        changed = {email for email, user in latest.items()
+                   if email not in previous or previous[email] != user}
+        removed = set(previous) - set(latest)
+
+        def grant(entry):
+            position, user = entry
+            if position in rejects or user.email in changed:  # still report warnings
+                return self.grant_entry(rejects, position, user)
+            return None
+
+        with self.metrics.phase('grant'):
+            issues = list(filter(None, self._map(grant, self.entries(rejects))))
+        with self.metrics.phase('revoke'):
+            issues += self.revoke_users(self.get_ego_users(sorted(changed | removed)))
+        return issues
+
     def get_daco_users_from_ego(self):
-        return self.get_ego_users(self.fetch_ego_ids())
+        # in the same order every run, whatever order ego lists them in
+        return self.get_ego_users(sorted(self.fetch_ego_ids()))
 
     def get_ego_users(self, ego_id_list):
         return map(self.get_user, ego_id_list)
 
     def get_user(self, ego_id):
         try:
-            return self._user_map[ego_id.lower()]
+            return self._user_map[email_key(ego_id)]
         except KeyError:
             return User(ego_id, None, False, False)
 
     def revoke_users(self, users):
-        return filter(None, map(self.revoke_user, users))
+        return filter(None, self._map(self.revoke_user, users))
 
     def revoke_user(self, user):
         try:
@@ -81,26 +344,29 @@ class DacoClient(object):
             return err_msg(e.args[0], e.args[1])
 
     def grant_access_if_necessary(self, user):
-        if not self.is_unique_user(user):
-            self.count("multiple_entries")
-            return f"Warning: User '{user}' has multiple entries in the daco " \
-                f"file!"
-
-        if user.invalid_email():
-            self.count("invalid_email")
-            return (f"Warning: User '{user}' does not have a valid email "
-                    f"address")
-
-        if user.is_invalid():
-            self.count('invalid')
-            return f"Warning: User '{user}' is invalid " \
-                f"(in cloud file, but not in DACO)"
+        warning = self.check_user(user)
+        if warning is not None:
+            return warning
+        return self.grant_access(user)
 
+    def grant_access(self, user):
+        """ Grant a user whose entry has passed our checks the access they need """
         if self.ego_client.user_exists(user.email):
             return self.existing_user(user)
 
         return self.new_user(user)
 
+    def check_user(self, user):
+        """ The checks we can make on a user without asking ego, against
+            the last entry we've seen for their email
+
+            returns: A warning if the user's entry has a problem, or None
+        """
+        reason = check(user, self.get_user(user.email))
+        if reason is not None:
+            return self.reject(user, reason)
+        return None
+
     # scenario 1
     def new_user(self, user):
         self.create_user(user)
@@ -164,6 +430,34 @@ class DacoClient(object):
             return f"Revoked cloud access for user '{user}'"
         return None
 
+    def journaled(self, op, group, emails, call):
+        """ Make a change in ego with call(), recording it in our journal
+            if we keep one, along with the id ego gives a new user.
+
+            returns: What call() returns
+        """
+        if self.journal is None:
+            return call()
+        with self.journal.record(op, group, emails) as outcome:
+            reply = call()
+            if isinstance(reply, dict) and reply.get('id'):
+                outcome['ego_id'] = reply['id']
+            return reply
+
+    def change_group(self, action, group, emails):
+        """ Add ('add') or remove ('remove') users from an ego group """
+        return self.journaled(action, group, emails,
+                              lambda: getattr(self.ego_client, action)(group, emails))
+
+    def created_earlier(self, user):
+        """ The ego id of a user the run we're resuming created, or None.
+            Ego's search may not find them yet, but we don't need it to.
+        """
+        ego_id = self.journal.created(user.email) if self.journal is not None else None
+        if ego_id is not None:
+            logging.info(f"Not creating user '{user}' again: the run we're resuming created them.")
+        return ego_id
+
     #####################################################################
     # Wrap all exceptions from our ego_client as LookupErrors
     # with nice context based messages for us to display if they happen.
@@ -177,7 +471,7 @@ class DacoClient(object):
         try:
             daco_users = set(self.ego_client.get_users(self.daco_group))
             cloud_users = set(self.ego_client.get_users(self.cloud_group))
-            return daco_users | cloud_users
+            return self.in_shard(daco_users | cloud_users)
         except Exception as e:
             raise LookupError(msg, e)
 
@@ -193,7 +487,11 @@ class DacoClient(object):
         if msg is None:
             msg = f"Can't create user '{user}'"
         try:
-            self.ego_client.create_user(user.email, user.name)
+            ego_id = self.created_earlier(user)
+            if ego_id is not None:
+                return self.ego_client.remember_user(user.email, ego_id)
+            return self.journaled(CREATE, None, [user.email],
+                                  lambda: self.ego_client.create_user(user.email, user.name))
         except Exception as e:
             self.count('create user', err=True)
             raise LookupError(msg, e)
@@ -220,7 +518,7 @@ class DacoClient(object):
         if msg is None:
             msg = f"Can't grant daco access to user '{user}'"
         try:
-            self.ego_client.add(self.daco_group, [user.email])
+            self.change_group('add', self.daco_group, [user.email])
         except Exception as e:
             self.count("grant DACO access", err=True)
             raise LookupError(msg, e)
@@ -229,7 +527,7 @@ class DacoClient(object):
         if msg is None:
             msg = f"Can't grant cloud access to user '{user}'"
         try:
-            self.ego_client.add(self.cloud_group, [user.email])
+            self.change_group('add', self.cloud_group, [user.email])
         except Exception as e:
             self.count("grant cloud access", err=True)
             raise LookupError(msg, e)
@@ -238,7 +536,7 @@ class DacoClient(object):
         if msg is None:
             msg = f"Can't revoke daco access for user '{user}'"
         try:
-            self.ego_client.remove(self.daco_group, [user.email])
+            self.change_group('remove', self.daco_group, [user.email])
         except Exception as e:
             self.count("revoke DACO access", err=True)
             raise LookupError(msg, e)
@@ -247,7 +545,7 @@ class DacoClient(object):
         if msg is None:
             msg = f"Can't revoke cloud access for user '{user}'"
         try:
-            self.ego_client.remove(self.cloud_group, [user.email])
+            self.change_group('remove', self.cloud_group, [user.email])
         except Exception as e:
             self.count("revoke cloud access", err=True)
             raise LookupError(msg, e)
@@ -1,11 +1,42 @@
 #!/usr/bin/python
+import sys
+
+
+def normalize_email(email):
+    """
+    The form of an email we keep, and send to ego in searches and new
+    users: without surrounding whitespace, and in lower case. Every email
+    from the approved users list or from ego goes through this.
+    """
+    return email.strip().lower()
+
+
+def email_key(email):
+    """
+    The form of an email we compare by, so that both sides agree on
+    who's who: normalized, and case folded (which also matches e.g. 'ß'
+    with 'ss'). Case folding loses information, so a key is only ever
+    used to look emails up, never as an address.
+    """
+    return normalize_email(email).casefold()
+
+
 class User(object):
+    # We can have millions of these, so no per instance __dict__
+    __slots__ = ('name', 'email', 'has_daco', 'has_cloud')
+
     def __init__(self, email, name, has_daco, has_cloud):
         self.name = name
-        self.email = email.lower()
+        self.email = sys.intern(normalize_email(email))
         self.has_daco = has_daco
         self.has_cloud = has_cloud
 
+    @property
+    def key(self):
+        """ Our email's email_key: almost always the (interned) email itself, not a copy of it """
+        key = self.email.casefold()
+        return self.email if key == self.email else key
+
     def invalid_email(self):
         """
         Is user's email clearly invalid?
@@ -20,7 +51,7 @@ class User(object):
 
     def __eq__(self, other):
         return (self.name == other.name and
-                self.email.lower() == other.email.lower() and
+                self.email == other.email and
                 self.has_daco == other.has_daco and
                 self.has_cloud == other.has_cloud)
 
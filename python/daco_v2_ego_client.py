@@ -1,31 +1,16 @@
 import logging
-from oauthlib.oauth2 import TokenExpiredError
+import threading
+import time
 
+from metrics import Metrics, endpoint_name
+from transport import retry_oauth
 
-def retry_oauth(func):
-    """
-    Decorator for methods making rest requests
-    Retry the request if encountering a TokenExpiredError by generating a new rest client with a new OAuth2 Bearer Token
-    :param func: function to decorate
-    :return: decorated function
-    """
-
-    def func_wrapper(self, *args, **kwargs):
-        try:
-            return func(self, *args, **kwargs)
-        except TokenExpiredError as e:
-            logging.info('Token expired for Daco2Ego, requesting new authorization.')
-            if self._rest_client_factory is not None:
-                self._rest_client = self._rest_client_factory()
-                return func(self, *args, **kwargs)
-            else:
-                raise e
-
-    return func_wrapper
+EXPORT = "/export/approved-users/?format=daco-file-format"
 
 
 class DacoV2EgoClient(object):
-    def __init__(self, ego_url, rest_client, dac_api_url, rest_client_factory=None):
+    def __init__(self, ego_url, rest_client, dac_api_url, rest_client_factory=None,
+                 metrics=None):
         logging.info("daco v2 ego client initializing")
         self.ego_url = ego_url
         self.dac_api_url = dac_api_url
@@ -33,18 +18,55 @@ class DacoV2EgoClient(object):
         self._rest_client_factory = rest_client_factory  # Function to produce new rest client if needed to re-auth
         self._rest_client = rest_client
         self._rest_client.stream = False
+        self._token_lock = threading.Lock()
+        self.metrics = metrics if metrics is not None else Metrics()
 
     @retry_oauth
     def _get(self, endpoint):
-        r = self._rest_client.get(self.ego_url + endpoint)
+        with self.metrics.timer(endpoint_name('ego', 'GET', endpoint)) as request:
+            r = self._rest_client.get(self.ego_url + endpoint)
+            request['size'] = len(r.content)
+            request['error'] = not r.ok
         if r.ok:
             return r.text
         raise IOError(f"Error trying to GET {r.url}", r)
 
     @retry_oauth
     def download_approved_users(self):
-        r = self._rest_client.get(self.dac_api_url + "/export/approved-users/?format=daco-file-format")
-        
+        with self.metrics.timer(endpoint_name('dac-api', 'GET', EXPORT)) as request:
+            r = self._rest_client.get(self.dac_api_url + EXPORT)
+            request['size'] = len(r.content)
+            request['error'] = not r.ok
+
         if r.ok:
             return r.text
-        raise IOError(f"Error requesting approved users from {r.url}", r)
\ No newline at end of file
+        raise IOError(f"Error requesting approved users from {r.url}", r)
+
+    @retry_oauth
+    def stream_approved_users(self):
+        """
+        Start downloading the approved users export, without waiting for all of it.
+        :return: A generator of the lines of the export, as they arrive
+        """
+        start = time.monotonic()
+        r = self._rest_client.get(self.dac_api_url + EXPORT, stream=True)
+        if not r.ok:
+            self.metrics.record(endpoint_name('dac-api', 'GET', EXPORT),
+                                time.monotonic() - start, error=True)
+            r.close()
+            raise IOError(f"Error requesting approved users from {r.url}", r)
+
+        if r.encoding is None:
+            r.encoding = 'utf-8'
+        return self._measured(r.iter_lines(decode_unicode=True), start)
+
+    def _measured(self, lines, start):
+        """ Pass on lines, then record the export's size and the time it took """
+        size = 0
+        try:
+            for line in lines:
+                size += len(line) + 1
+                yield line
+        finally:
+            self.metrics.record(endpoint_name('dac-api', 'GET', EXPORT),
+                                time.monotonic() - start, size)
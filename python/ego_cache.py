@@ -0,0 +1,323 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from daco_user import email_key, normalize_email
+
+
+def email_hash(email):
+    """ A 64 bit hash of an email's email_key """
+    return int.from_bytes(hashlib.blake2b(email_key(email).encode(), digest_size=8).digest(), 'big')
+
+
+class Members(object):
+    """
+    The emails of a group's members, which answers `in` by email_key,
+    but still lists the members by their (normalized) addresses.
+
+    Almost every address is its own key; we only keep a key apart for
+    the few that case folding changes.
+
+    :param emails: The members' emails
+    """
+
+    def __init__(self, emails=()):
+        self._emails = set()
+        self._keys = {}  # key -> address, where they differ
+        self.update(emails)
+
+    def __contains__(self, email):
+        key = email_key(email)
+        return key in self._keys or key in self._emails
+
+    def __iter__(self):
+        return iter(self._emails)
+
+    def __len__(self):
+        return len(self._emails)
+
+    def update(self, emails):
+        for email in emails:
+            email = normalize_email(email)
+            self._emails.add(email)
+            key = email.casefold()
+            if key != email:
+                self._keys[key] = email
+
+    def difference_update(self, emails):
+        for email in emails:
+            key = email_key(email)
+            self._emails.discard(self._keys.pop(key, key))
+
+
+class HashedMembers(object):
+    """
+    The emails of a group's members, kept as a sorted array of 64 bit
+    hashes: eight bytes a member, rather than a string in a set. It
+    answers `in` like Members does, but can't list its members.
+
+    If two members' emails share a hash, we download the members again
+    to keep the emails for that hash, and compare those exactly. An email
+    that isn't a member but shares a hash with one (about a one in 10^13
+    chance for a million members) would be taken for a member.
+
+    :param fetch: A function returning an iterable of the members' emails
+    """
+
+    def __init__(self, fetch):
+        self._hashes = array('Q', sorted(email_hash(e) for e in fetch()))
+        shared = {a for a, b in zip(self._hashes, self._hashes[1:]) if a == b}
+        self._exact = {}  # hash -> set of emails, for hashes members share
+        if shared:
+            for email in fetch():
+                h = email_hash(email)
+                if h in shared:
+                    self._exact.setdefault(h, set()).add(email_key(email))
+
+    def _find(self, h):
+        i = bisect_left(self._hashes, h)
+        return i if i < len(self._hashes) and self._hashes[i] == h else None
+
+    def __contains__(self, email):
+        h = email_hash(email)
+        if h in self._exact:
+            return email_key(email) in self._exact[h]
+        return self._find(h) is not None
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def update(self, emails):
+        for email in emails:
+            if email not in self:
+                h = email_hash(email)
+                self._hashes.insert(bisect_left(self._hashes, h), h)
+                if h in self._exact:  # members share the hash, so it must be compared exactly
+                    self._exact[h].add(email_key(email))
+
+    def difference_update(self, emails):
+        for email in emails:
+            h = email_hash(email)
+            if h in self._exact:
+                if email_key(email) not in self._exact[h]:
+                    continue
+                self._exact[h].discard(email_key(email))
+            i = self._find(h)
+            if i is not None:
+                del self._hashes[i]
+
+
+class MembershipCache(object):
+    """
+    A per-run snapshot of ego group memberships.
+
+    Each group is downloaded at most once, the first time it's asked for,
+    and kept as Members until it is invalidated. Changes
+    we make ourselves are written through to the snapshot with add() and
+    discard(), so it stays correct without another download.
+
+    :param hashed: Keep each snapshot as HashedMembers, rather than as
+        Members, to save memory.
+    """
+
+    def __init__(self, hashed=False):
+        self.hashed = hashed
+        self._groups = {}
+        self._loaded = set()  # groups we've downloaded at least once
+        self._lock = threading.RLock()
+        self.stats = {'hits': 0, 'misses': 0, 'refreshes': 0}
+
+    def get(self, group, fetch):
+        """
+        Return the cached members of group, calling fetch(group) to
+        download them if we don't have a snapshot yet.
+        :param group: The group name
+        :param fetch: A function returning the members of a group
+        :return: The Members (or HashedMembers) of the group
+        """
+        with self._lock:
+            try:
+                members = self._groups[group]
+            except KeyError:
+                if self.hashed:
+                    members = HashedMembers(lambda: fetch(group))
+                else:
+                    members = Members(fetch(group))
+                self._groups[group] = members
+                if group in self._loaded:
+                    self.stats['refreshes'] += 1
+                else:
+                    self.stats['misses'] += 1
+                    self._loaded.add(group)
+            else:
+                self.stats['hits'] += 1
+            return members
+
+    def __contains__(self, group):
+        return group in self._groups
+
+    def invalidate(self, group=None):
+        """
+        Forget the snapshot for group, or for every group if group is None
+        """
+        with self._lock:
+            if group is None:
+                self._groups.clear()
+            else:
+                self._groups.pop(group, None)
+
+    def add(self, group, users):
+        """
+        Record that users were added to group, if we have a snapshot of it
+        """
+        with self._lock:
+            if group in self._groups:
+                self._groups[group].update(users)
+
+    def discard(self, group, users):
+        """
+        Record that users were removed from group, if we have a snapshot of it
+        """
+        with self._lock:
+            if group in self._groups:
+                self._groups[group].difference_update(users)
+
+
+class UserIdIndex(object):
+    """
+    A memo of ego user ids, keyed by email_key.
+
+    Each email maps to the list of ids ego has for it; an empty list is a
+    negative entry for an email we know isn't in ego. Once the index has
+    been loaded from a full download of the ego users it is complete, and
+    any email it doesn't know about is missing from ego.
+    """
+
+    def __init__(self):
+        self._ids = {}  # email -> an id, a tuple of ids, or None (to ask ego)
+        self.complete = False
+
+    @staticmethod
+    def _pack(ids):
+        # almost every email has one id; a plain string is the smallest way to keep it
+        return ids[0] if len(ids) == 1 else tuple(ids)
+
+    def get(self, email):
+        """
+        :param email: The user's email
+        :return: The list of ego ids for email, or None if we don't know
+        """
+        ids = self._ids.get(email_key(email), () if self.complete else None)
+        if ids is None:
+            return None
+        return [ids] if isinstance(ids, str) else list(ids)
+
+    def put(self, email, ids):
+        self._ids[email_key(email)] = self._pack(list(ids))
+
+    def add(self, email, user_id):
+        """
+        Record the id of a user we've just created in ego
+        """
+        self.put(email, (self.get(email) or []) + [user_id])
+
+    def forget(self, email):
+        """
+        Forget what we know about email, so the next lookup asks ego again
+        """
+        if self.complete:
+            self._ids[email_key(email)] = None
+        else:
+            self._ids.pop(email_key(email), None)
+
+    def load(self, users):
+        """
+        Replace the index with the given ego user records
+        :param users: An iterable of ego user records (with 'email' and 'id')
+        """
+        ids = {}
+        for user in users:
+            email = email_key(user['email'])
+            if email in ids:
+                previous = ids[email]
+                previous = [previous] if isinstance(previous, str) else list(previous)
+                ids[email] = self._pack(previous + [user['id']])
+            else:
+                ids[email] = user['id']
+        self._ids = ids
+        self.complete = True
+
+    def emails(self):
+        """
+        :return: The set of email_keys of the emails we know to be in ego
+        """
+        return {email for email, ids in self._ids.items() if ids}
+
+    def __len__(self):
+        return sum(1 for ids in self._ids.values() if ids)
+
+
+class GroupIdCache(object):
+    """
+    Remembers the ego id of each group name for ttl seconds.
+
+    If a path is given, the cache is loaded from and saved to that (json)
+    file, so that resolved ids survive between runs.
+    """
+
+    def __init__(self, ttl=86400, path=None, clock=time.time):
+        self.ttl = ttl
+        self.path = path
+        self._clock = clock
+        self._ids = {}  # group name -> (id, time it was resolved)
+        self._lock = threading.Lock()
+        if path is not None:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                self._ids = {k: tuple(v) for k, v in json.load(f).items()}
+        except FileNotFoundError:
+            pass
+        except (ValueError, AttributeError, TypeError) as e:
+            logging.warning(f"Ignoring unreadable group id cache {self.path}: {e}")
+
+    def _save(self):
+        try:
+            with open(self.path, "w") as f:
+                json.dump(self._ids, f)
+        except OSError as e:
+            logging.warning(f"Can't save group id cache {self.path}: {e}")
+
+    def get(self, group, resolve):
+        """
+        Return the id for group, calling resolve(group) to look it up
+        if we don't have an id for it, or the one we have has expired.
+        """
+        with self._lock:
+            try:
+                group_id, resolved = self._ids[group]
+                if self._clock() - resolved < self.ttl:
+                    return group_id
+            except KeyError:
+                pass
+
+            group_id = resolve(group)
+            self._ids[group] = (group_id, self._clock())
+            if self.path is not None:
+                self._save()
+            return group_id
+
+    def invalidate(self, group=None):
+        with self._lock:
+            if group is None:
+                self._ids.clear()
+            else:
+                self._ids.pop(group, None)
+            if self.path is not None:
+                self._save()
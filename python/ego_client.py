@@ -1,45 +1,66 @@
 import json
-import logging
-from oauthlib.oauth2 import TokenExpiredError
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
+from daco_user import email_key, normalize_email
+from ego_cache import GroupIdCache, MembershipCache, UserIdIndex
+from metrics import Metrics, endpoint_name
+from transport import retry_oauth
 
-def retry_oauth(func):
+
+def split_for_url(items, max_length):
     """
-    Decorator for methods making rest requests
-    Retry the request if encountering a TokenExpiredError by generating a new rest client with a new OAuth2 Bearer Token
-    :param func: function to decorate
-    :return: decorated function
+    Split a list of strings into runs whose comma separated form is
+    no longer than max_length (a run always has at least one item).
+    :param items:
+    :param max_length:
+    :return: A generator of lists
     """
-
-    def func_wrapper(self, *args, **kwargs):
-        try:
-            return func(self, *args, **kwargs)
-        except TokenExpiredError as e:
-            logging.info('Token expired for Daco2Ego, requesting new authorization.')
-            if self._rest_client_factory is not None:
-                self._rest_client = self._rest_client_factory()
-                return func(self, *args, **kwargs)
-            else:
-                raise e
-
-    return func_wrapper
+    run, length = [], 0
+    for item in items:
+        if run and length + 1 + len(item) > max_length:
+            yield run
+            run, length = [], 0
+        length += len(item) + (1 if run else 0)
+        run.append(item)
+    if run:
+        yield run
 
 
 class EgoClient(object):
-    def __init__(self, base_url, rest_client, rest_client_factory=None):
+    def __init__(self, base_url, rest_client, rest_client_factory=None,
+                 page_size=1000, group_ids=None, max_url_length=2000,
+                 page_workers=4, metrics=None, hashed_members=False):
         self.base_url = base_url
+        self.page_size = page_size
+        self.page_workers = page_workers
+        self.max_url_length = max_url_length
 
         self._rest_client_factory = rest_client_factory  # Function to produce new rest client if needed to re-auth
         self._rest_client = rest_client
         self._rest_client.stream = False
+        self._token_lock = threading.Lock()
+        self._members = MembershipCache(hashed_members)
+        self._user_ids = UserIdIndex()
+        self._group_ids = group_ids if group_ids is not None else GroupIdCache()
+        self.metrics = metrics if metrics is not None else Metrics()
 
     @retry_oauth
     def _get(self, endpoint):
-        r = self._rest_client.get(self.base_url + endpoint)
+        r = self._request('GET', endpoint)
         if r.ok:
             return r.text
         raise IOError(f"Error trying to GET {r.url}", r)
 
+    def _request(self, method, endpoint, **kwargs):
+        send = getattr(self._rest_client, method.lower())
+        with self.metrics.timer(endpoint_name('ego', method, endpoint)) as request:
+            r = send(self.base_url + endpoint, **kwargs)
+            request['size'] = len(r.content)
+            request['error'] = not r.ok
+        return r
+
     def _get_json(self, endpoint):
         result = self._get(endpoint)
         j = json.loads(result)
@@ -48,26 +69,28 @@ class EgoClient(object):
     @retry_oauth
     def _post(self, endpoint, data):
         headers = {'Content-type': 'application/json'}
-        r = self._rest_client.post(self.base_url + endpoint, data=data,
-                                   headers=headers)
+        r = self._request('POST', endpoint, data=data, headers=headers)
         if r.ok:
             return r.text
         raise IOError(f"Error trying to POST to {endpoint}", r, data)
 
     @retry_oauth
     def _delete(self, endpoint):
-        return self._rest_client.delete(self.base_url + endpoint)
+        r = self._request('DELETE', endpoint)
+        if r.ok:
+            return r.text
+        raise IOError(f"Error trying to DELETE {endpoint}", r)
 
     def _field_search(self, endpoint, name, value):
         query = endpoint + f"?{name}={value}&limit=9999999"
         result = self._get_json(query)
         if result['count'] == 0:
-            raise IOError(f"No matches for {value} from ego endpoint {query}",
-                          result)
+            raise LookupError(f"No matches for {value} from ego endpoint "
+                              f"{query}", result)
 
         # Return only exact matches from the field search
         matches = [item for item in result['resultSet']
-                   if item[name].lower() == value.lower()]
+                   if email_key(item[name]) == email_key(value)]
         if not matches:
             raise LookupError(f"Can't find {value} in results from endpoint "
                               f"{query}", result)
@@ -80,27 +103,124 @@ class EgoClient(object):
         :param group:
         :return:
         """
+        return self._group_ids.get(group, self._search_group_id)
+
+    @contextmanager
+    def _group_request(self, group):
+        """
+        Forget our id for the group if ego says it has no such group (it
+        may have been deleted and made again), so we look it up next time
+        """
+        try:
+            yield
+        except IOError as e:
+            if len(e.args) > 1 and getattr(e.args[1], 'status_code', None) == 404:
+                self._group_ids.invalidate(group)
+            raise
+
+    def _search_group_id(self, group):
         group_ids = self._field_search("/groups", "name", group)
         if len(group_ids) > 1:
             raise LookupError(f"Multiple ids matched group '{group}': {group_ids}")
         return group_ids[0]['id']
 
+    def _search_user_ids(self, user):
+        try:
+            return [u['id'] for u in self._field_search("/users", "email", user)]
+        except LookupError:
+            return []
+
     def _user_id(self, user):
-        user_ids = self._field_search("/users", "email", user)
+        user_ids = self._user_ids.get(user)
+        if user_ids is None:
+            user_ids = self._search_user_ids(user)
+            self._user_ids.put(user, user_ids)
+
+        if not user_ids:
+            raise LookupError(f"Can't find user '{user}' in ego")
         if len(user_ids) > 1:
             raise LookupError(f"Multiple ids matched user '{user}': {user_ids}")
-        return user_ids[0]['id']
+        return user_ids[0]
+
+    def _pages(self, endpoint):
+        """
+        Yield every item from a paginated ego endpoint, page by page.
+
+        The first page tells us how many items there are; once we know,
+        the rest of the pages are fetched page_workers at a time.
+        :param endpoint:
+        :return:
+        """
+        separator = '&' if '?' in endpoint else '?'
+
+        def page(offset):
+            return self._get_json(f"{endpoint}{separator}offset={offset}"
+                                  f"&limit={self.page_size}")
+
+        first = page(0)
+        yield from first['resultSet']
+        offsets = range(self.page_size, first['count'], self.page_size)
+        if not offsets:
+            return
+        with ThreadPoolExecutor(self.page_workers) as pool:
+            for result in pool.map(page, offsets):
+                yield from result['resultSet']
+
+    def load_users(self):
+        """
+        Download every ego user, page by page, and index their ids by email.
+        After this, user lookups don't need to ask ego at all.
+        :return: The number of emails indexed
+        """
+        self._user_ids.load(self._pages("/users"))
+        return len(self._user_ids)
+
+    def iter_users(self, group):
+        """
+        Download the users in the given group from ego, page by page.
+        :param group:
+        :return: A generator of (normalized) user emails
+        """
+        group_id = self._group_id(group)
+        with self._group_request(group):
+            for user in self._pages(f"/groups/{group_id}/users"):
+                yield normalize_email(user['email'])
+
+    def all_users(self):
+        """
+        Return the set of email_keys of every user in ego.
+        Downloads (and indexes) the ego users if we haven't already.
+        :return:
+        """
+        if not self._user_ids.complete:
+            self.load_users()
+        return self._user_ids.emails()
 
     def get_users(self, group):
         """
-        Return a list of users in the given group
+        Return a set of users in the given group.
+
+        The group is downloaded from ego the first time it's asked for;
+        after that the answer comes from our membership snapshot. If we
+        keep hashed snapshots, which can't list their members, it's
+        downloaded every time.
         :param group:
         :return:
         """
-        group_id = self._group_id(group)
-        results = self._get_json(f"/groups/{group_id}/users?limit=9999999")
+        if self._members.hashed:
+            return set(self.iter_users(group))
+        return set(self._members.get(group, self.iter_users))
 
-        return {user['email'] for user in results['resultSet']}
+    def group_size(self, group):
+        """
+        Return the number of users in the given group, asking ego for
+        just the count, rather than the whole group.
+        :param group:
+        :return:
+        """
+        group_id = self._group_id(group)
+        with self._group_request(group):
+            return self._get_json(f"/groups/{group_id}/users?offset=0&limit=1")['count']
 
     def is_member(self, group, user):
         """
@@ -109,7 +229,39 @@ class EgoClient(object):
         :param group:
         :return:
         """
-        return user in self.get_users(group)
+        return user in self._members.get(group, self.iter_users)
+
+    def invalidate(self, group=None):
+        """
+        Drop our membership snapshot of the group (or of all groups),
+        so that the next query downloads it from ego again.
+        :param group: The group name, or None for every group
+        :return:
+        """
+        self._members.invalidate(group)
+
+    def refresh(self, group):
+        """
+        Download a fresh membership snapshot for the group right away.
+        :param group:
+        :return: The set of users in the group
+        """
+        self.invalidate(group)
+        return self.get_users(group)
+
+    def read_latency(self):
+        """
+        Return the average time our GET requests to ego have taken so far
+        :return: The time in seconds, or None if we haven't made any
+        """
+        return self.metrics.mean_latency('ego GET ')
+
+    def cache_stats(self):
+        """
+        Return the hit, miss and refresh counts for the membership snapshot
+        :return: A dictionary of counts
+        """
+        return dict(self._members.stats)
 
     def user_exists(self, user):
         """
@@ -129,8 +281,19 @@ class EgoClient(object):
                         "status": "APPROVED"})
         reply = self._post("/users", j)
         r = json.loads(reply)
+        if isinstance(r, dict) and r.get('id'):
+            self.remember_user(user, r['id'])
+        else:
+            self._user_ids.forget(user)  # drop our negative entry for them
         return r
 
+    def remember_user(self, user, user_id):
+        """
+        Record the id of a user we know is in ego, such as one we've just
+        created: ego's search may not find them yet, and we don't need it to.
+        """
+        self._user_ids.add(user, user_id)
+
     def add(self, group, users):
         """
         Add the users to the given group.
@@ -142,16 +305,37 @@ class EgoClient(object):
         user_ids = list(map(self._user_id, users))
         group_id = self._group_id(group)
         j = json.dumps(user_ids)
-        return self._post(f"/groups/{group_id}/users", j)
+        try:
+            with self._group_request(group):
+                reply = self._post(f"/groups/{group_id}/users", j)
+        except Exception:
+            self.invalidate(group)  # we don't know what ego did
+            raise
+        self._members.add(group, users)
+        return reply
 
     def remove(self, group, users):
         """
         Remove the users from the given group.
+
+        The user ids go in the url, so if there are too many of them for
+        one url we make as many DELETE requests as it takes.
         :param group:
         :param users:
         :return:
         """
-        user_ids = list(map(self._user_id, users))
+        email = dict(zip(map(self._user_id, users), users))
         group_id = self._group_id(group)
-        j = ",".join(user_ids)
-        return self._delete(f"/groups/{group_id}/users/{j}")
+        endpoint = f"/groups/{group_id}/users/"
+        max_length = self.max_url_length - len(self.base_url + endpoint)
+
+        reply = None
+        for user_ids in split_for_url(list(email), max_length):
+            try:
+                with self._group_request(group):
+                    reply = self._delete(endpoint + ",".join(user_ids))
+            except Exception:
+                self.invalidate(group)  # we don't know what ego did
+                raise
+            self._members.discard(group, [email[i] for i in user_ids])
+        return reply
@@ -2,8 +2,7 @@ import re
 
 def format_tuple(name, args):
     if len(args) == 1:
-        args[0] = filter_sensitive(args[0])
-        return f"{name}({args[0]})"
+        return f"{name}({filter_sensitive(args[0])})"
 
     args = tuple(filter_sensitive(arg) for arg in args)
     return f"{name}{args}"
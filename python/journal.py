@@ -0,0 +1,158 @@
+import json
+import logging
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+CREATE = 'create'
+ADD = 'add'
+REMOVE = 'remove'
+
+
+def read(path):
+    """
+    :return: The records in a journal file, skipping a last line left
+        half written by a crash
+    """
+    try:
+        with open(path) as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return []
+    records = []
+    for number, line in enumerate(lines, 1):
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            logging.warning(f"Skipping unreadable line {number} of journal {path}")
+    return records
+
+
+def confirmed(records):
+    """
+    :param records: The records of a journal, oldest first
+    :return: A dictionary of the (op, group, email) changes that ego
+        confirmed since the last run that finished, to the ego id ego
+        gave the user (for a create), or None
+    """
+    planned = {}  # (run, id) -> record
+    done = {}
+    for record in records:
+        event = record.get('event')
+        if event == 'end':
+            planned, done = {}, {}
+        elif event == 'planned':
+            planned[(record['run'], record['id'])] = record
+        elif event == 'done':
+            change = planned.get((record['run'], record['id']))
+            if change is not None:
+                for email in change['users']:
+                    done[(change['op'], change['group'], email)] = record.get('ego_id')
+    return done
+
+
+class Journal(object):
+    """
+    A write-ahead journal of the changes a run makes in ego, as lines of
+    JSON appended to a file: each change is written as planned before
+    we ask ego to make it, then as done or failed. It's the audit trail
+    of exactly which ego calls a run made, and lets a run that died part
+    way through be resumed.
+
+    A resumed run still checks everything against ego, which already
+    shows the changes the last run made, and makes any change ego doesn't
+    have, even if the journal says it was made. The exception is users the
+    last run created: ego's search may not find them yet, so we take
+    their ids from the journal instead of creating them again.
+
+    Each record is flushed to the operating system as it is written, so a
+    crashed process loses nothing, but only fsynced to disk every
+    sync_every records (and at the end of a run): a machine that goes down
+    can lose the last few, and the resumed run then makes those changes again.
+
+    :param path: The journal file, which is created if need be
+    :param sync_every: How many records to write between fsyncs
+    """
+
+    def __init__(self, path, sync_every=100):
+        self.path = path
+        self.sync_every = sync_every
+        self.run = uuid.uuid4().hex
+        self._confirmed = {}
+        self._ids = 0
+        self._unsynced = 0
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def start(self, resume=False):
+        """
+        Record the start of a run
+        :param resume: If set, pick up the changes confirmed since the
+            last run that finished
+        :return: How many changes that is
+        """
+        if resume:
+            self._confirmed = confirmed(read(self.path))
+        self._write({'event': 'start', 'resume': resume}, sync=True)
+        return len(self._confirmed)
+
+    def finish(self, counts, errors):
+        """ Record the end of a run, so the next one starts afresh """
+        self._write({'event': 'end', 'counts': counts, 'errors': len(errors)}, sync=True)
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+    def created(self, email):
+        """
+        :return: The ego id of the user with email, if the run we're
+            resuming created them, or None
+        """
+        return self._confirmed.get((CREATE, None, email))
+
+    @contextmanager
+    def record(self, op, group, emails):
+        """
+        Journal the change made in the body of a with statement
+        :param op: CREATE, ADD or REMOVE
+        :param group: The ego group for ADD and REMOVE, or None
+        :param emails: The users the change is for
+        :return: A dictionary for the body to add details of the outcome to
+            (e.g. the 'ego_id' of a new user), for the done record
+        """
+        redone = [e for e in emails if (op, group, e) in self._confirmed]
+        if redone:
+            logging.warning(f"Redoing '{op}' ({group}) for {redone}: the run we're "
+                            f"resuming made the change, but ego doesn't have it now.")
+        with self._lock:
+            self._ids += 1
+            change_id = self._ids
+        self._write({'event': 'planned', 'id': change_id, 'op': op, 'group': group,
+                     'users': list(emails)})
+        outcome = {}
+        try:
+            yield outcome
+        except Exception as e:
+            self._write({'event': 'failed', 'id': change_id, 'error': str(e)})
+            raise
+        self._write(dict(outcome, event='done', id=change_id))
+
+    def _write(self, record, sync=False):
+        record = dict(record, time=datetime.now(timezone.utc).isoformat(timespec='milliseconds'),
+                      run=self.run)
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self._unsynced += 1
+            if sync or self._unsynced >= self.sync_every:
+                self._sync()
+
+    def _sync(self):
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
@@ -0,0 +1,124 @@
+import math
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+# The ids (or comma separated lists of ids) in ego paths follow the collection they're in
+_ID = re.compile(r'/(groups|users)/[^/?]+')
+
+
+def endpoint_name(service, method, path):
+    """
+    :return: A name for the endpoint that path is a request to, with no
+             query string, and with ego ids replaced by {id}, so that all
+             the requests to one endpoint share a name.
+             e.g. "ego GET /groups/{id}/users"
+    """
+    path = _ID.sub(r'/\1/{id}', path.split('?', 1)[0])
+    return f"{service} {method} {path}"
+
+
+def percentile(ordered, p):
+    """ The p-th percentile of a sorted list (nearest rank) """
+    if not ordered:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class Metrics(object):
+    """
+    Counts the requests we make to each endpoint, and how many bytes and
+    seconds they took, and how long each phase of a run took, so that we
+    can tell where a slow run spends its time.
+
+    One Metrics can be shared by all of our clients, from any thread.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._requests = {}  # endpoint -> {'latencies': [...], 'bytes': n, 'errors': n}
+        self._phases = {}  # phase -> seconds
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, size=0, error=False):
+        """
+        :param endpoint: The endpoint's name (see endpoint_name())
+        :param seconds: How long the request took
+        :param size: How many bytes came back
+        :param error: Whether the request failed
+        """
+        with self._lock:
+            r = self._requests.setdefault(endpoint, {'latencies': [], 'bytes': 0, 'errors': 0})
+            r['latencies'].append(seconds)
+            r['bytes'] += size
+            r['errors'] += bool(error)
+
+    @contextmanager
+    def timer(self, endpoint):
+        """
+        Record the time taken by the body of a with statement as a request
+        to endpoint. The body may set 'size' and 'error' in the dictionary
+        it's given; an exception counts as an error.
+        """
+        start = self._clock()
+        result = {'size': 0, 'error': False}
+        try:
+            yield result
+        except BaseException:
+            result['error'] = True
+            raise
+        finally:
+            self.record(endpoint, self._clock() - start, result['size'], result['error'])
+
+    @contextmanager
+    def phase(self, name):
+        """ Add the time taken by the body of a with statement to phase name """
+        start = self._clock()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._phases[name] = self._phases.get(name, 0.0) + self._clock() - start
+
+    def count(self, prefix=""):
+        """ The number of requests to endpoints whose names start with prefix """
+        with self._lock:
+            return sum(len(r['latencies']) for e, r in self._requests.items()
+                       if e.startswith(prefix))
+
+    def mean_latency(self, prefix=""):
+        """
+        :return: The average time of the requests to endpoints whose names
+                 start with prefix, or None if we haven't made any
+        """
+        with self._lock:
+            latencies = [t for e, r in self._requests.items() if e.startswith(prefix)
+                         for t in r['latencies']]
+        return sum(latencies) / len(latencies) if latencies else None
+
+    def phases(self):
+        with self._lock:
+            return dict(self._phases)
+
+    def endpoints(self):
+        """
+        :return: A dictionary of endpoint name to its request count, error
+                 count, bytes, total seconds, and p50, p95 and p99 latencies
+        """
+        with self._lock:
+            requests = {e: (sorted(r['latencies']), r['bytes'], r['errors'])
+                        for e, r in self._requests.items()}
+        summary = {}
+        for endpoint, (latencies, size, errors) in sorted(requests.items()):
+            summary[endpoint] = {'requests': len(latencies), 'errors': errors,
+                                 'bytes': size, 'seconds': sum(latencies),
+                                 'p50': percentile(latencies, 50),
+                                 'p95': percentile(latencies, 95),
+                                 'p99': percentile(latencies, 99)}
+        return summary
+
+    def summary(self):
+        return {'phases': self.phases(), 'endpoints': self.endpoints()}
+
@@ -0,0 +1,90 @@
+import cProfile
+import logging
+import os
+import sys
+import threading
+import traceback
+import tracemalloc
+from contextlib import contextmanager
+
+
+class StackSampler(object):
+    """
+    Logs the stack of every thread every interval seconds, so that a slow
+    run can be diagnosed from its log afterwards, without reproducing it.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            logging.info(self.snapshot())
+
+    def snapshot(self):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        text = "Stack snapshot:\n"
+        for ident, frame in sys._current_frames().items():
+            if ident == self._thread.ident:
+                continue
+            text += f"Thread {names.get(ident, ident)}:\n"
+            text += "".join(traceback.format_stack(frame))
+        return text
+
+
+def write_allocations(path, snapshot, peak, limit=25):
+    """ Save the peak traced memory, and the lines that allocated the most memory """
+    with open(path, 'w') as f:
+        f.write(f"Peak traced memory: {peak / 1024 / 1024:.1f} MB\n\n")
+        f.write(f"Top {limit} allocation sites:\n")
+        for stat in snapshot.statistics('lineno')[:limit]:
+            f.write(f"{stat}\n")
+
+
+@contextmanager
+def profile(directory=None, sample_interval=None):
+    """
+    Profile the body of a with statement.
+
+    :param directory: If set, run under cProfile and tracemalloc, and save
+        daco2ego.pstats (for pstats or snakeviz) and daco2ego.memory.txt
+        (the peak memory and the top allocation sites) there.
+        cProfile only sees the thread that starts it; time spent in our
+        worker threads shows up as waiting for them.
+    :param sample_interval: If set, log a stack snapshot every this many seconds
+    """
+    sampler = StackSampler(sample_interval).start() if sample_interval else None
+    profiler = None
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+        tracemalloc.start(10)
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            try:
+                profiler.dump_stats(os.path.join(directory, "daco2ego.pstats"))
+                write_allocations(os.path.join(directory, "daco2ego.memory.txt"), snapshot, peak)
+            except OSError as e:
+                # the run is over by now; this mustn't stop us reporting it
+                logging.warning(f"Can't save the profile in {directory}: {e}")
+            else:
+                logging.info(f"Profile saved in {directory}; peak traced memory {peak / 1024 / 1024:.1f} MB")
+        if sampler is not None:
+            sampler.stop()
@@ -0,0 +1,97 @@
+import email.utils
+import random
+import threading
+import time
+
+# Responses that mean ego is overloaded, or briefly unavailable
+RETRY_STATUSES = frozenset([429, 502, 503, 504])
+
+
+def retry_after(response, now=None):
+    """
+    :return: How many seconds the Retry-After header of response asks us
+             to wait (it may be a number of seconds, or an HTTP date), or None
+    """
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if now is None:
+        now = time.time()
+    return max(0.0, when.timestamp() - now)
+
+
+def backoff(attempt, base=0.5, cap=30.0):
+    """
+    :return: How long to wait before retry number attempt (from 0): a random
+             time up to base * 2^attempt seconds ("full jitter"), so that
+             clients that failed together don't all retry together.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class AdaptiveLimiter(object):
+    """
+    Limits how many requests we send to ego at once, adapting the limit
+    the way TCP adapts its window (AIMD): each quick, successful response
+    raises the limit a little, and each response saying ego is overloaded
+    (a 429 or 5xx, or one slower than target_latency) cuts it back
+    sharply. A Retry-After from ego holds every request until it's over.
+
+    :param maximum: The most requests to have in flight at once
+    :param minimum: The fewest
+    :param target_latency: How many seconds a response may take before we
+        take it as a sign that ego is getting busy (None to ignore latency)
+    """
+
+    def __init__(self, maximum=10, minimum=1, target_latency=None, clock=time.monotonic):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.target_latency = target_latency
+        self.limit = float(maximum)
+        self.in_flight = 0
+        self.throttled = 0
+        self._clock = clock
+        self._paused_until = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while True:
+                wait = self._paused_until - self._clock()
+                if wait > 0:
+                    self._condition.wait(wait)
+                elif self.in_flight >= int(self.limit):
+                    self._condition.wait()
+                else:
+                    break
+            self.in_flight += 1
+
+    def release(self, latency, overloaded=False):
+        """
+        :param latency: How many seconds the request took
+        :param overloaded: Whether ego told us it was overloaded
+        """
+        with self._condition:
+            self.in_flight -= 1
+            slow = self.target_latency is not None and latency > self.target_latency
+            if overloaded:
+                self.throttled += 1
+                self.limit = max(self.minimum, self.limit / 2)
+            elif slow:
+                self.limit = max(self.minimum, self.limit * 0.9)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def pause(self, seconds):
+        """ Hold every request for the next seconds """
+        with self._condition:
+            self._paused_until = max(self._paused_until, self._clock() + seconds)
@@ -72,10 +72,68 @@ def report_errors(errors):
     return report
 
 
-def create(counts, errors, ran):
+def report_performance(performance):
+    """
+    :param performance: A Metrics.summary(), of the phases and ego requests of a run
+    """
+    report = "\n*Performance*:\n"
+    phases = performance['phases']
+    if phases:
+        report += "\t" + ", ".join(f"{name} {seconds:.1f}s" for name, seconds in phases.items()) + "\n"
+
+    endpoints = performance['endpoints']
+    for name, e in endpoints.items():
+        report += (f"\t{name}: {e['requests']} requests, {e['bytes'] / 1024:.0f}KB, "
+                   f"p50 {e['p50'] * 1000:.0f}ms, p95 {e['p95'] * 1000:.0f}ms, "
+                   f"p99 {e['p99'] * 1000:.0f}ms\n")
+    requests = sum(e['requests'] for e in endpoints.values())
+    seconds = sum(e['seconds'] for e in endpoints.values())
+    report += f"\tTotal: {requests} requests, {seconds:.1f}s waiting for responses\n"
+    return report
+
+
+def create(counts, errors, ran, performance=None):
     report = "*Daco2Ego Report Summary*\n\n"
     report += report_errors(errors)
     if ran:
         report += report_warnings(counts)
         report += summarize(counts)
+        if performance is not None:
+            report += report_performance(performance)
     return report
+
+
+def describe_changes(title, emails):
+    if not emails:
+        return ""
+    report = f"*{title}* ({len(emails)}):\n"
+    for email in emails:
+        report += f"\t{email}\n"
+    return report
+
+
+def create_plan(plan, requests, latency, concurrency=1):
+    """
+    Describe a plan of changes, without making any of them.
+    :param plan: A sync_plan.Plan
+    :param requests: How many ego requests the plan will take
+    :param latency: The average time (in seconds) of an ego request, or None
+    :param concurrency: How many requests the run will make at once
+    :return: The report text
+    """
+    report = "*Daco2Ego Plan*\n\n"
+    report += report_warnings(plan.counts())
+    report += summarize(plan.counts())
+    report += "\n"
+    report += describe_changes("Create", [u.email for u in plan.creates])
+    report += describe_changes("Grant DACO", plan.daco_adds)
+    report += describe_changes("Grant Cloud", plan.cloud_adds)
+    report += describe_changes("Revoke DACO", plan.daco_removes)
+    report += describe_changes("Revoke Cloud", plan.cloud_removes)
+
+    report += f"\n*Estimate*: {requests} ego requests"
+    if latency is not None:
+        report += f", about {requests * latency / concurrency:.0f} seconds " \
+                  f"(at {latency * 1000:.0f}ms per request"
+        report += f", {concurrency} at a time)" if concurrency > 1 else ")"
+    return report + "\n"
@@ -0,0 +1,91 @@
+import json
+import os
+
+from ego_cache import email_hash
+
+
+class Shard(object):
+    """
+    One of count slices of the users, by a stable hash of their normalized
+    email, so that count processes (or machines) can each sync a slice.
+
+    Every entry for an email, and that email's ego account, fall in the
+    same slice whichever list they come from, so a shard can check for
+    multiple entries, and decide what to revoke, on its own.
+
+    :param index: Which slice, from 0 to count - 1
+    :param count: How many slices there are
+    """
+
+    def __init__(self, index, count):
+        if not 0 <= index < count:
+            raise ValueError(f"Shard {index} isn't one of 0 to {count - 1}")
+        self.index = index
+        self.count = count
+
+    @classmethod
+    def parse(cls, spec):
+        """ :param spec: A shard as 'index/count', e.g. '0/4' """
+        index, _, count = spec.partition('/')
+        try:
+            return cls(int(index), int(count))
+        except ValueError:
+            raise ValueError(f"Expected a shard like '0/4' (index/count), not '{spec}'")
+
+    def __contains__(self, email):
+        return email_hash(email) % self.count == self.index
+
+    def __str__(self):
+        return f"{self.index}/{self.count}"
+
+    def select(self, users):
+        """
+        :param users: A list of User objects, or an iterator of them
+        :return: The users in this shard, as a list or an iterator to match
+        """
+        if isinstance(users, (list, tuple)):
+            return [u for u in users if u.email in self]
+        return (u for u in users if u.email in self)
+
+    def path(self, path):
+        """ A file of our own, for a setting that names one file for a whole run """
+        return f"{path}.{self.index}-of-{self.count}"
+
+
+def result_path(directory, index, count):
+    return os.path.join(directory, f"shard-{index}-of-{count}.json")
+
+
+def save_result(directory, shard, counts, errors, issues, ran):
+    """ Save what a shard did, for merge_results to report with the others """
+    os.makedirs(directory, exist_ok=True)
+    path = result_path(directory, shard.index, shard.count)
+    with open(path + ".tmp", "w") as f:
+        json.dump({'counts': counts, 'errors': errors, 'issues': issues, 'ran': ran}, f)
+    os.replace(path + ".tmp", path)  # so a merge never reads half a file
+
+
+def merge_results(directory, count):
+    """
+    Combine the results of all count shards of a run, and remove them,
+    so that the next run's merge can't report them again.
+
+    :return: The counts, errors and issues of the whole run, and whether
+        any shard ran; a shard that didn't save a result is an error
+    """
+    counts, errors, issues, ran = {}, [], [], False
+    for index in range(count):
+        path = result_path(directory, index, count)
+        try:
+            with open(path) as f:
+                result = json.load(f)
+        except (OSError, ValueError) as e:
+            errors.append(f"*Error:* No result from shard {index}/{count}: {e}")
+            continue
+        for category, n in result['counts'].items():
+            counts[category] = counts.get(category, 0) + n
+        errors += result['errors']
+        issues += result['issues']
+        ran = ran or result['ran']
+        os.remove(path)
+    return counts, errors, issues, ran
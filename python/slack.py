@@ -1,4 +1,4 @@
-from requests import Session
+from transport import Transport
 
 
 def slack_escape(txt):
@@ -9,11 +9,11 @@ def slack_escape(txt):
 
 
 class Reporter(object):
-    def __init__(self, url):
+    def __init__(self, url, transport=None):
         self.url = url
-        self.session = Session()
+        self.transport = transport if transport is not None else Transport()
 
     def send(self, report):
         headers = {'Content-type': 'application/json'}
         data = {"text": slack_escape(report), "username": "markdownbot", "mrkdwn": True}
-        return self.session.post(self.url, json=data, headers=headers)
+        return self.transport.request('POST', self.url, json=data, headers=headers)
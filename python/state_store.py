@@ -0,0 +1,122 @@
+import hashlib
+import sqlite3
+import time
+
+from daco_user import User
+
+
+def users_hash(users):
+    """
+    :param users: A list of User objects
+    :return: A hash of the contents of the list
+    """
+    h = hashlib.sha256()
+    for u in users:
+        h.update(repr((u.email, u.name, u.has_daco, u.has_cloud)).encode())
+    return h.hexdigest()
+
+
+class RunState(object):
+    """ What we knew about the approved users and ego after a run """
+
+    def __init__(self, users, export_hash, counts, last_full):
+        self.users = users
+        self.export_hash = export_hash
+        self.counts = counts
+        self.last_full = last_full
+
+
+class StateStore(object):
+    """
+    Keeps the approved users list we last applied to ego, the hash of
+    that list, and the sizes of the ego groups afterwards, in an SQLite
+    database, so the next run can work on just what has changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS users "
+                             "(email TEXT PRIMARY KEY, name TEXT, "
+                             "has_daco INTEGER, has_cloud INTEGER)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta "
+                             "(key TEXT PRIMARY KEY, value TEXT)")
+
+    def close(self):
+        self._db.close()
+
+    def load(self):
+        """
+        :return: The RunState we saved last, or None if we don't have one
+        """
+        meta = dict(self._db.execute("SELECT key, value FROM meta"))
+        if 'export_hash' not in meta:
+            return None
+        users = {email: User(email, name, bool(daco), bool(cloud))
+                 for email, name, daco, cloud
+                 in self._db.execute("SELECT * FROM users")}
+        counts = (int(meta['daco_count']), int(meta['cloud_count']))
+        return RunState(users, meta['export_hash'], counts,
+                        float(meta.get('last_full', 0)))
+
+    def save(self, users, export_hash, counts, full):
+        """
+        Replace the saved state
+        :param users: A dictionary of email to User
+        :param export_hash: The users_hash of the approved users list
+        :param counts: The sizes of the (daco, cloud) groups in ego
+        :param full: True if this run checked every user
+        """
+        with self._db:
+            self._db.execute("DELETE FROM users")
+            self._db.executemany("INSERT INTO users VALUES (?, ?, ?, ?)",
+                                 ((e, u.name, u.has_daco, u.has_cloud)
+                                  for e, u in users.items()))
+            meta = {'export_hash': export_hash,
+                    'daco_count': counts[0], 'cloud_count': counts[1]}
+            if full:
+                meta['last_full'] = time.time()
+            self._db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                                 ((k, str(v)) for k, v in meta.items()))
+
+
+def sync_incremental(daco_client, store, full_sync, force_full=False,
+                     full_interval=7 * 86400):
+    """
+    Bring ego up to date, doing as little work as we can.
+
+    We compare the approved users list and the ego group sizes with what
+    we saved after the last run. If neither has changed, there's nothing
+    to do. If only the list has changed, we just check the users whose
+    entries changed. If the groups have changed under us, we don't have a
+    saved state, the last full run was more than full_interval seconds
+    ago, or force_full is set, we run full_sync() and check everyone.
+
+    :param daco_client: A DacoClient
+    :param store: A StateStore
+    :param full_sync: A function that syncs every user, returning the issues
+    :return: A list of issues encountered
+    """
+    with daco_client.metrics.phase('download'):
+        users = daco_client.approved_users()
+        counts = daco_client.group_sizes()
+    export_hash = users_hash(users)
+    previous = store.load()
+
+    full = (force_full or previous is None or previous.counts != counts or
+            time.time() - previous.last_full > full_interval)
+    if full:
+        issues = full_sync()
+    elif previous.export_hash == export_hash:
+        return []
+    else:
+        issues = daco_client.update_ego_changes(previous.users)
+
+    # If anything went wrong, keep the old state, so that the next run
+    # looks at the users we failed on again.
+    _, errors = daco_client.get_summary()
+    if not errors:
+        store.save(daco_client.latest_users(), export_hash,
+                   daco_client.group_sizes(), full)
+    return issues
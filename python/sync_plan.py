@@ -0,0 +1,199 @@
+from collections import Counter
+from math import ceil
+
+from daco_user import User, email_key
+from ego_cache import Members
+from validation import validate, warning
+
+DACO = 'daco'
+CLOUD = 'cloud'
+
+
+class Change(object):
+    """
+    A change we plan to make for one user, and how to report it.
+
+    :param user: The User the change is for
+    :param category: The report category to count the change under
+    :param message: The message to put in the issues log
+    :param create: True if the user needs to be created in ego
+    :param add: The groups (DACO, CLOUD) to add the user to
+    :param remove: The groups (DACO, CLOUD) to remove the user from
+    """
+
+    def __init__(self, user, category, message, create=False, add=(),
+                 remove=()):
+        self.user = user
+        self.category = category
+        self.message = message
+        self.create = create
+        self.add = tuple(add)
+        self.remove = tuple(remove)
+
+    def __repr__(self):
+        return self.__class__.__name__ + f"({self.user!r},{self.category}," \
+                                         f"create={self.create}," \
+                                         f"add={self.add}," \
+                                         f"remove={self.remove})"
+
+
+class Plan(object):
+    """
+    The list of changes that bring ego in line with the approved users list,
+    in the order the per user scenarios would have made them.
+    """
+
+    def __init__(self, changes=None):
+        self.changes = list(changes or [])
+
+    def __iter__(self):
+        return iter(self.changes)
+
+    def __len__(self):
+        return len(self.changes)
+
+    def _emails(self, attr, group):
+        return [c.user.email for c in self.changes if group in getattr(c, attr)]
+
+    @property
+    def creates(self):
+        return [c.user for c in self.changes if c.create]
+
+    @property
+    def daco_adds(self):
+        return self._emails('add', DACO)
+
+    @property
+    def cloud_adds(self):
+        return self._emails('add', CLOUD)
+
+    @property
+    def daco_removes(self):
+        return self._emails('remove', DACO)
+
+    @property
+    def cloud_removes(self):
+        return self._emails('remove', CLOUD)
+
+    def request_count(self, batch_size=None):
+        """
+        :param batch_size: How many users we add or remove per request
+        :return: How many ego requests making the changes will take
+        """
+        batch_size = batch_size or 1
+        groups = (self.daco_adds, self.cloud_adds, self.daco_removes,
+                  self.cloud_removes)
+        return len(self.creates) + sum(ceil(len(g) / batch_size) for g in groups)
+
+    def counts(self):
+        """
+        :return: The number of changes in each report category, as
+                 report.create expects them.
+        """
+        return dict(Counter(c.category for c in self.changes))
+
+
+def grant_change(user, ego_users, daco, cloud):
+    if user.email not in ego_users:
+        if user.has_cloud:
+            return Change(user, 'new_cloud',
+                          f"Created user '{user}' with cloud access",
+                          create=True, add=(DACO, CLOUD))
+        return Change(user, 'new_daco',
+                      f"Created user '{user}' with daco access",
+                      create=True, add=(DACO,))
+
+    grant_daco = user.email not in daco
+    grant_cloud = user.has_cloud and user.email not in cloud
+
+    if grant_daco and grant_cloud:
+        return Change(user, 'grant_both',
+                      f"Granted daco and cloud to existing user '{user}'",
+                      add=(DACO, CLOUD))
+    elif grant_daco:
+        return Change(user, 'grant_daco',
+                      f"Granted daco to existing user '{user}'",
+                      add=(DACO,))
+    elif grant_cloud:
+        return Change(user, 'grant_cloud',
+                      f"Granted cloud to existing user '{user}",
+                      add=(CLOUD,))
+    return None
+
+
+def revoke_change(user, daco, cloud):
+    in_daco, in_cloud = user.email in daco, user.email in cloud
+    groups = [g for g, member in ((DACO, in_daco), (CLOUD, in_cloud)) if member]
+
+    if user.is_invalid():
+        return Change(user, 'revoke_invalid',
+                      f"Revoked all access for invalid user '{user}':(on "
+                      f"cloud access list, but not DACO)",
+                      remove=groups)
+
+    if not user.has_daco and (in_daco or in_cloud):
+        return Change(user, 'revoke_daco',
+                      f"Revoked all access for user '{user}'",
+                      remove=groups)
+
+    if not user.has_cloud and in_cloud:
+        return Change(user, 'revoke_cloud',
+                      f"Revoked cloud access for user '{user}'",
+                      remove=(CLOUD,))
+    return None
+
+
+def make_plan(users, ego_users, daco_members, cloud_members):
+    """
+    Work out what has to change in ego, without asking ego anything.
+
+    :param users: The approved users, as a list of User objects
+    :param ego_users: The emails of every user in ego
+    :param daco_members: The emails of the members of the DACO group
+    :param cloud_members: The emails of the members of the cloud group
+    :return: A Plan
+    """
+    ego_users = Members(ego_users)
+    daco = Members(daco_members)
+    cloud = Members(cloud_members)
+
+    # the last entry for an email is the one that counts
+    latest = {email_key(u.email): u for u in users}
+    rejects = validate(users)
+
+    changes = []
+    seen = set()
+    for position, user in enumerate(users):
+        reason = rejects.reason(position)
+        if reason is None:
+            # an exact repeat of an entry we grant already; each rejected
+            # entry is counted, as update_ego counts them
+            if email_key(user.email) in seen:
+                continue
+            seen.add(email_key(user.email))
+
+        if reason is not None:
+            change = Change(user, reason, warning(user, reason))
+        else:
+            change = grant_change(user, ego_users, daco, cloud)
+        if change is not None:
+            changes.append(change)
+
+    # Revocation looks at group membership after our grants
+    for change in changes:
+        if DACO in change.add:
+            daco.update([change.user.email])
+        if CLOUD in change.add:
+            cloud.update([change.user.email])
+
+    revoked = set()
+    for email in sorted(set(daco) | set(cloud)):
+        if email_key(email) in revoked:
+            continue
+        revoked.add(email_key(email))
+        user = latest.get(email_key(email), User(email, None, False, False))
+        change = revoke_change(user, daco, cloud)
+        if change is not None:
+            changes.append(change)
+
+    return Plan(changes)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Run daco2ego end to end against the local stand-in server, at a range of
+dataset sizes, and report how fast it goes.
+
+    python -m tests.benchmark.run --users 1000 10000 --latency 0.005 \
+        --client '{"planner": true, "batch_size": 100}'
+
+Each run is a separate daco2ego process, so its peak RSS is its own.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from tests.benchmark.server import Dataset, StandInServer, config
+
+PYTHON_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def run_once(server, client):
+    """
+    Run daco2ego once against server
+    :param client: Extra settings for the "client" section of the config
+    :return: The seconds the run took, the requests it made, and its peak RSS in KB
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "benchmark.conf")
+        with open(path, "w") as f:
+            json.dump(config(server.url, **client), f)
+
+        # the stand-in server doesn't do https
+        env = dict(os.environ, OAUTHLIB_INSECURE_TRANSPORT="1")
+        requests = server.requests
+        start = time.monotonic()
+        with open(os.path.join(tmp, "output"), "w+") as output:
+            process = subprocess.Popen([sys.executable, "daco2ego.py", path], cwd=PYTHON_DIR,
+                                       env=env, stdout=output, stderr=subprocess.STDOUT)
+            _, status, usage = os.wait4(process.pid, 0)
+            seconds = time.monotonic() - start
+            # as subprocess reports it: the exit code, or minus the signal that killed it
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            output.seek(0)
+            report = output.read()
+    if process.returncode or "*Updates*" not in report:
+        raise RuntimeError(f"daco2ego didn't run (status {process.returncode}):\n{report[-4096:]}")
+    return seconds, server.requests - requests, usage.ru_maxrss
+
+
+def benchmark(size, runs=1, latency=0.0, error_rate=0.0, changed=0.01, client=None):
+    """
+    :return: A dictionary of results for runs of daco2ego over a dataset of size users
+    """
+    dataset = Dataset(size, changed)
+    results = []
+    with StandInServer(dataset, latency=latency, error_rate=error_rate) as server:
+        for _ in range(runs):
+            results.append(run_once(server, client or {}))
+            # later runs start from what the first one left, so they've nothing to change
+    seconds = [r[0] for r in results]
+    return {'users': size, 'runs': runs, 'seconds': seconds,
+            'runs_per_second': len(seconds) / sum(seconds),
+            'users_per_second': size * len(seconds) / sum(seconds),
+            'requests': [r[1] for r in results],
+            'peak_rss_kb': max(r[2] for r in results)}
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000],
+                        help="the dataset sizes to run at")
+    parser.add_argument('--runs', type=int, default=1, help="runs at each size")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds the server waits before each answer")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="the fraction of ego requests to fail with a 503")
+    parser.add_argument('--changed', type=float, default=0.01,
+                        help="the fraction of users that ego isn't up to date for")
+    parser.add_argument('--client', type=json.loads, default={},
+                        help="extra settings for the client config, as JSON")
+    parser.add_argument('--json', help="a file to save the results to")
+    return parser.parse_args(args)
+
+
+def main(*args):
+    options = parse_args(args)
+    results = []
+    print(f"{'users':>10} {'seconds':>10} {'users/s':>10} {'requests':>10} {'peak RSS':>10}")
+    for size in options.users:
+        r = benchmark(size, options.runs, options.latency, options.error_rate,
+                      options.changed, options.client)
+        results.append(r)
+        print(f"{size:>10} {r['seconds'][0]:>10.2f} {r['users_per_second']:>10.0f} "
+              f"{r['requests'][0]:>10} {r['peak_rss_kb'] // 1024:>8}MB")
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,160 @@
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from tests.integration.fuzz import numbered_userlist
+from tests.mock_rest_client import MockEgoServer
+
+EXPORT_HEADER = "USER NAME,OPENID,EMAIL,CHANGED,AFFILIATION\n"
+
+
+class Dataset(object):
+    """
+    A generated set of approved users, and the state ego starts in.
+
+    :param size: How many approved users there are
+    :param changed: The fraction of them ego isn't up to date for: half of
+        those are new to ego, and half only have DACO access. As many
+        again of ego's users have access they should lose.
+    :param seed: For the random number generator, so that runs repeat
+    """
+
+    def __init__(self, size, changed=0.01, seed=0):
+        random.seed(seed)
+        self.users = numbered_userlist(size)
+        n = int(size * changed)
+        self.new = self.users[:n // 2]
+        self.daco_only = self.users[n // 2:n]
+        self.revoked = [f"gone{i}@example.com" for i in range(n)]
+
+    def ego_server(self, daco_group, cloud_group):
+        new = {u.email for u in self.new}
+        daco_only = {u.email for u in self.daco_only}
+        daco = [u.email for u in self.users if u.email not in new] + self.revoked
+        cloud = [e for e in daco if e not in daco_only]
+        return MockEgoServer(groups={daco_group: daco, cloud_group: cloud})
+
+    def export(self):
+        lines = [EXPORT_HEADER]
+        for u in self.users:
+            lines.append(f"{u.name},{u.email},{u.email},2023-01-01T00:00,OICR\n")
+        return "".join(lines)
+
+
+class StandInServer(object):
+    """
+    A local HTTP stand-in for ego (under /ego) and the dac-api (under
+    /dac-api), and a slack webhook (/slack), for running daco2ego
+    end to end against a generated dataset.
+
+    :param dataset: A Dataset
+    :param latency: How many seconds to wait before answering each request
+    :param error_rate: The fraction of ego requests to answer with a 503
+    """
+
+    def __init__(self, dataset, daco_group="DACO", cloud_group="CLOUD",
+                 latency=0.0, error_rate=0.0):
+        self.dataset = dataset
+        self.latency = latency
+        self.error_rate = error_rate
+        self.ego = dataset.ego_server(daco_group, cloud_group)
+        self.requests = 0
+        self.errors = 0
+        self._export = dataset.export().encode()
+        self._lock = threading.Lock()
+        self._random = random.Random(0)
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._httpd.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle(self, method, path, body):
+        """ :return: The status code, content type and body to answer a request with """
+        with self._lock:
+            self.requests += 1
+            fail = self._random.random() < self.error_rate
+        if self.latency:
+            time.sleep(self.latency)
+
+        if path.endswith('/oauth/token'):
+            token = {"access_token": "benchmark", "token_type": "bearer", "expires_in": 3600}
+            return 200, 'application/json', json.dumps(token).encode()
+        if path.startswith('/slack'):
+            return 200, 'text/plain', b"ok"
+        if path.startswith('/dac-api/export/approved-users'):
+            return 200, 'text/csv', self._export
+        if path.startswith('/ego/'):
+            if fail:
+                with self._lock:
+                    self.errors += 1
+                return 503, 'application/json', b'{"error": "Injected failure"}'
+            with self._lock:
+                status, result = self.ego.handle(method, path[len('/ego'):], body)
+            if not isinstance(result, str):
+                result = json.dumps(result)
+            return status, 'application/json', result.encode()
+        return 404, 'text/plain', b"Not found"
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep connections alive
+            disable_nagle_algorithm = True  # don't hold back small responses
+
+            def _answer(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length).decode() if length else None
+                status, content_type, content = server.handle(self.command, self.path, body)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_DELETE = _answer
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def config(url, **client):
+    """ A daco2ego configuration that uses the stand-in server at url """
+    return {
+        "client": dict({"base_url": url + "/ego", "client_id": "daco2ego",
+                        "client_secret": "secret", "daco_group": "DACO",
+                        "cloud_group": "CLOUD"}, **client),
+        "daco_v2_client": {"ego_url": url + "/ego", "dac_api_url": url + "/dac-api",
+                           "client_id": "dac-api", "client_secret": "secret"},
+        "slack": {"url": url + "/slack"},
+    }
+
+
+if __name__ == "__main__":
+    with StandInServer(Dataset(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)) as s:
+        print(f"Serving ego at {s.url}/ego and the dac-api at {s.url}/dac-api")
+        print(json.dumps(config(s.url), indent=2))
+        s._thread.join()
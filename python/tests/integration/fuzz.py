@@ -28,6 +28,12 @@ def sequential_userlist(n):
         users.append(User(f"{x}@google.ca",f"User {x}",True, False))
     return users
 
+def numbered_userlist(n):
+    users = []
+    for i in range(n):
+        users.append(User(f"user{i}@example.com", f"User {i}", True, coin_flip()))
+    return users
+
 def coin_flip():
     if randint(0, 1) == 1:
         return True
@@ -1,3 +1,4 @@
+import threading
 from collections import OrderedDict
 
 
@@ -13,20 +14,29 @@ class MockIO(object):
         return self.call_log
 
     def log_call(self, key, value):
-        if key not in self.call_log:
-            self.call_log[key] = []
-        self.call_log[key].append(value)
+        self.call_log.setdefault(key, []).append(value)
 
 
 class MockEgoSuccess(MockIO):
     def __init__(self, groups):
         super(MockEgoSuccess, self).__init__()
         self.groups = groups
+        self.batches = []
+        # the DacoClient may call us from several worker threads
+        self._lock = threading.Lock()
 
     def get_users(self, group):
         self.log_call('get_users', group)
         return self.groups[group]
 
+    def all_users(self):
+        self.log_call('all_users', None)
+        return set(self.groups['users'])
+
+    def group_size(self, group):
+        self.log_call('group_size', group)
+        return len(self.groups[group])
+
     def is_member(self, group, user):
         self.log_call('is_member',(group,user))
         return user in self.groups[group]
@@ -39,19 +49,30 @@ class MockEgoSuccess(MockIO):
                 return True
         return False
 
-    def create_user(self, user, name):
+    def read_latency(self):
+        return 0.25
+
+    def cache_stats(self):
+        return {}
+
+    def create_user(self, user, name, ego_type="USER"):
         self.log_call('create_user', (user, name))
-        self.groups['users'] = user
+        with self._lock:
+            self.groups['users'].append(user)
 
     def add(self, group, users):
-        assert len(users) == 1
-        self.log_call('add', (group,users[0]))
-        self.groups[group] += users
+        self.batches.append(('add', group, len(users)))
+        for user in users:
+            self.log_call('add', (group, user))
+        with self._lock:
+            self.groups[group] += users
 
     def remove(self, group, users):
-        assert len(users) == 1
-        self.log_call('remove',(group, users[0]))
-        self.groups[group] += users
+        self.batches.append(('remove', group, len(users)))
+        for user in users:
+            self.log_call('remove', (group, user))
+        with self._lock:
+            self.groups[group] = [u for u in self.groups[group] if u not in users]
 
 
 class MockEgoException(Exception):
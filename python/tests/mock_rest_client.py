@@ -0,0 +1,146 @@
+import json
+from urllib.parse import urlsplit, parse_qs
+
+
+class MockResponse(object):
+    def __init__(self, url, status_code, body):
+        self.url = url
+        self.status_code = status_code
+        self.text = body if isinstance(body, str) else json.dumps(body)
+        self.content = self.text.encode()
+        self.ok = status_code < 400
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class MockEgoServer(object):
+    """
+    An in-memory stand-in for the parts of the ego REST api that
+    EgoClient uses. Every request is recorded in request_log as a
+    (method, path) tuple, so tests can count round trips.
+    """
+
+    def __init__(self, groups=None, users=None):
+        self.users = {}  # id -> user record
+        self.groups = {}  # id -> group record
+        self.members = {}  # group id -> set of user ids
+        self._ids = {}  # email -> user id
+        self._sorted = {}  # group id -> sorted member ids, as of the last first page
+        self.request_log = []
+        self.query_log = []
+
+        for email in users or []:
+            self.create_user(email)
+        for name, emails in (groups or {}).items():
+            group_id = self.create_group(name)
+            for email in emails:
+                user_id = self.find_user(email) or self.create_user(email)
+                self.members[group_id].add(user_id)
+
+    # Data setup
+    def create_user(self, email, first="", last=""):
+        user_id = f"u{len(self.users) + 1}"
+        self.users[user_id] = {"id": user_id, "email": email,
+                               "firstName": first, "lastName": last,
+                               "type": "USER", "status": "APPROVED"}
+        self._ids.setdefault(email, user_id)
+        return user_id
+
+    def create_group(self, name):
+        group_id = f"g{len(self.groups) + 1}"
+        self.groups[group_id] = {"id": group_id, "name": name}
+        self.members[group_id] = set()
+        return group_id
+
+    def find_user(self, email):
+        return self._ids.get(email)
+
+    def group_emails(self, name):
+        group_id = [k for k, v in self.groups.items() if v['name'] == name][0]
+        return {self.users[u]['email'] for u in self.members[group_id]}
+
+    def calls(self, method=None):
+        return [c for c in self.request_log if method is None or c[0] == method]
+
+    # Request handling
+    @staticmethod
+    def _page(items, query):
+        offset = int(query.get('offset', ['0'])[0])
+        limit = int(query.get('limit', ['20'])[0])
+        return {"count": len(items), "limit": limit, "offset": offset,
+                "resultSet": items[offset:offset + limit]}
+
+    @staticmethod
+    def _search(items, query, field):
+        if field not in query:
+            return items
+        value = query[field][0].lower()
+        return [i for i in items if value in i[field].lower()]
+
+    def handle(self, method, url, data=None):
+        parts = urlsplit(url)
+        path = parts.path
+        query = parse_qs(parts.query)
+        self.request_log.append((method, path))
+        self.query_log.append((method, path, query))
+        segments = path.strip('/').split('/')
+
+        if segments == ['users']:
+            if method == 'GET':
+                users = self._search(list(self.users.values()), query, 'email')
+                return 200, self._page(users, query)
+            body = json.loads(data)
+            user_id = self.create_user(body['email'], body['firstName'],
+                                       body['lastName'])
+            return 200, self.users[user_id]
+
+        if segments == ['groups']:
+            groups = self._search(list(self.groups.values()), query, 'name')
+            return 200, self._page(groups, query)
+
+        if len(segments) >= 3 and segments[:1] == ['groups'] and \
+                segments[2] == 'users':
+            group_id = segments[1]
+            if group_id not in self.groups:
+                return 404, {"error": f"No group {group_id}"}
+            members = self.members[group_id]
+            if method == 'GET':
+                # the pages after the first are from the same snapshot
+                if query.get('offset', ['0']) == ['0'] or group_id not in self._sorted:
+                    self._sorted[group_id] = sorted(members)
+                users = [self.users[u] for u in self._sorted[group_id]]
+                return 200, self._page(users, query)
+            if method == 'POST':
+                user_ids = json.loads(data)
+                if any(u not in self.users for u in user_ids):
+                    return 404, {"error": "Unknown user"}
+                members.update(user_ids)
+                return 200, self.groups[group_id]
+            if method == 'DELETE':
+                members.difference_update(segments[3].split(','))
+                return 200, ""
+        return 404, {"error": f"Unknown endpoint {path}"}
+
+
+class MockRestClient(object):
+    """ Looks enough like an OAuth2Session to be handed to EgoClient """
+
+    def __init__(self, server, base_url=""):
+        self.server = server
+        self.base_url = base_url
+        self.stream = False
+
+    def _request(self, method, url, data=None):
+        endpoint = url[len(self.base_url):] if url.startswith(self.base_url) else url
+        status, body = self.server.handle(method, endpoint, data)
+        return MockResponse(url, status, body)
+
+    def get(self, url, **kwargs):
+        return self._request('GET', url)
+
+    def post(self, url, data=None, **kwargs):
+        return self._request('POST', url, data)
+
+    def delete(self, url, **kwargs):
+        return self._request('DELETE', url)
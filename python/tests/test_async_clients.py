@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+import asyncio
+import threading
+import time
+
+from oauthlib.oauth2 import TokenExpiredError
+
+from async_daco_client import AsyncDacoClient
+from async_ego_client import AsyncEgoClient
+from daco_client import DacoClient
+from daco_user import User
+from ego_client import EgoClient
+from sync_plan import DACO, Change, Plan
+from tests.mock_ego_client import MockEgoSuccess
+from tests.mock_rest_client import MockEgoServer, MockRestClient
+from tests.test_daco_client import daco_client
+
+base_url = "https://ego/v1"
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_async_sync_matches_sync():
+    d, _ = daco_client()
+    expected = d.sync()
+
+    d, e = daco_client()
+    client = AsyncDacoClient(d, AsyncEgoClient(e, 4))
+    issues = run(client.sync())
+
+    assert issues == expected
+    assert client.get_summary() == d.get_summary()
+    assert sorted(e.get_calls()['add']) == sorted(
+        [('daco', 'a@ca'), ('daco', 'aa@ca'), ('cloud', 'aa@ca'),
+         ('cloud', 'b@ca'), ('daco', 'd@ca'), ('daco', 'e@ca'),
+         ('cloud', 'e@ca')])
+
+
+def test_async_sync_errors():
+    d, e = daco_client(success=False)
+    issues = run(AsyncDacoClient(d, AsyncEgoClient(e, 4)).sync())
+    assert issues == ["Error: Can't get the current state of ego -- "
+                      "MockEgoException(all_users())"]
+
+
+class SlowAdd(MockEgoSuccess):
+    def add(self, group, users):
+        time.sleep(0.05)
+        super(SlowAdd, self).add(group, users)
+
+
+def test_changes_for_a_user_in_order():
+    # a plan can grant a group and then revoke it; the revoke must come last
+    user = User('u@ca', 'Person U', False, False)
+    plan = Plan([Change(user, 'grant_daco', "granted", add=(DACO,)),
+                 Change(user, 'revoke_daco', "revoked", remove=(DACO,))])
+    e = SlowAdd({'daco': [], 'cloud': []})
+    d = DacoClient('daco', 'cloud', [user], e)
+    assert run(AsyncDacoClient(d, AsyncEgoClient(e, 4)).apply(plan)) == ["granted", "revoked"]
+    assert e.groups['daco'] == []
+
+
+class SlowClient(object):
+    def __init__(self):
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self.lock = threading.Lock()
+
+    def is_member(self, group, user):
+        with self.lock:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        time.sleep(0.01)
+        with self.lock:
+            self.in_flight -= 1
+        return True
+
+
+def test_concurrency_limit():
+    slow = SlowClient()
+    client = AsyncEgoClient(slow, 5)
+
+    async def check_all():
+        return await asyncio.gather(*[client.is_member('daco', str(i))
+                                      for i in range(50)])
+
+    assert run(check_all()) == [True] * 50
+    assert slow.most_in_flight == 5
+    client.close()
+
+
+def test_one_token_refresh():
+    server = MockEgoServer(groups={'daco': ['a@ca', 'b@ca']})
+    expired = MockRestClient(server, base_url)
+
+    def get_expired(url, **kwargs):
+        time.sleep(0.01)
+        raise TokenExpiredError()
+
+    expired.get = get_expired
+    refreshes = []
+
+    def new_client():
+        refreshes.append(1)
+        return MockRestClient(server, base_url)
+
+    client = AsyncEgoClient(EgoClient(base_url, expired, new_client), 20)
+
+    async def check_all():
+        return await asyncio.gather(*[client.user_exists(f"{u}@ca")
+                                      for u in 'abcdefghij'])
+
+    assert run(check_all()) == [True, True] + [False] * 8
+    assert len(refreshes) == 1
+    client.close()
@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+from daco2ego import init
+from tests.benchmark.run import benchmark
+from tests.benchmark.server import Dataset, StandInServer, config
+
+
+def test_stand_in_server(monkeypatch):
+    monkeypatch.setenv('OAUTHLIB_INSECURE_TRANSPORT', '1')
+    dataset = Dataset(20, changed=0.2)
+    with StandInServer(dataset) as server:
+        daco_client = init(config(server.url))
+        assert len(daco_client.approved_users()) == 20
+        ego = daco_client.ego_client
+        assert len(ego.get_users('DACO')) == 18 + 4  # 2 new users, 4 to revoke
+        assert len(ego.get_users('CLOUD')) == 16 + 4
+
+        daco_client.sync()
+        assert server.ego.group_emails('DACO') == {u.email for u in dataset.users}
+        assert server.ego.group_emails('CLOUD') == {u.email for u in dataset.users}
+
+
+def test_benchmark():
+    result = benchmark(50, runs=2, changed=0.2, client={'planner': True})
+    assert result['users'] == 50 and len(result['seconds']) == 2
+    # the second run has nothing left to change
+    assert result['requests'][1] < result['requests'][0]
+    assert result['peak_rss_kb'] > 0
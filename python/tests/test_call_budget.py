@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+How many requests each kind of run makes to ego, counted at the HTTP
+level by MockEgoServer. A change that brings back a round trip per user
+(like downloading a whole group to check one member) breaks these.
+"""
+from daco_client import DacoClient
+from daco_user import User
+from ego_client import EgoClient
+from tests.mock_rest_client import MockEgoServer, MockRestClient
+
+base_url = "https://ego/v1"
+sizes = (10, 100, 1000)
+
+
+def approved(n):
+    return [User(f"user{i}@example.com", f"User {i}", True, True) for i in range(n)]
+
+
+def run(users, ego_users, engine='update_ego', preload=False, batch_size=None, others=()):
+    """
+    Bring an ego with ego_users in both groups (and the others in neither)
+    up to date with users
+    :return: The (method, path) of every request the run made to ego
+    """
+    emails = [u.email for u in ego_users]
+    server = MockEgoServer(groups={'daco': emails, 'cloud': emails},
+                           users=[u.email for u in others])
+    ego_client = EgoClient(base_url, MockRestClient(server, base_url), page_size=10000)
+    client = DacoClient('daco', 'cloud', users, ego_client, batch_size=batch_size)
+    if preload:
+        ego_client.load_users()
+    issues = getattr(client, engine)()
+    assert not client.get_summary()[1], issues
+    return server.request_log
+
+
+def writes(requests):
+    return [r for r in requests if r[0] != 'GET']
+
+
+def test_no_op_run_is_constant():
+    # The user list, the group ids, and one download of each group
+    for engine, preload in (('update_ego', True), ('sync', False), ('sync', True)):
+        for n in sizes:
+            users = approved(n)
+            requests = run(users, users, engine, preload)
+            assert len(requests) == 5, (engine, preload, n, requests)
+
+
+def test_per_user_lookups_without_preload():
+    # update_ego without preload_users searches ego for each user; this is
+    # the baseline the other engines are measured against.
+    for n in sizes:
+        users = approved(n)
+        assert len(run(users, users)) == 4 + n
+
+
+def test_new_cloud_user_budget():
+    for engine, preload, batch_size in (('update_ego', True, None), ('sync', False, None),
+                                        ('sync', True, None), ('sync', False, 100)):
+        for n in sizes:
+            users = approved(n)
+            baseline = len(run(users, users, engine, preload, batch_size))
+            new = User("new@example.com", "New User", True, True)
+            requests = run(users + [new], users, engine, preload, batch_size)
+
+            # create the user and add it to each group, with the id ego gave us
+            assert len(requests) - baseline == 3, (engine, preload, batch_size, n, requests)
+            assert len(writes(requests)) == 3
+
+
+def test_changed_users_cost_one_write_each():
+    for n in sizes:
+        users = approved(n)
+        grants, synced = users[:n // 10], users[n // 10:]
+        requests = run(users, synced, 'sync', True, others=grants)
+        # each group gets one POST per user
+        assert len(writes(requests)) == 2 * len(grants)
+        assert len(requests) - len(writes(requests)) == 5
+
+        requests = run(users, synced, 'sync', True, batch_size=100, others=grants)
+        assert len(writes(requests)) == 2 * -(-len(grants) // 100)
+
+
+def test_mixed_case_ego_accounts_are_members():
+    # ego keeps emails as they were entered; we mustn't re-grant these every run
+    users = approved(10)
+    for engine, preload in (('update_ego', True), ('update_ego', False), ('sync', False)):
+        emails = [u.email.title() for u in users[:5]] + [u.email.upper() + ' ' for u in users[5:]]
+        server = MockEgoServer(groups={'daco': emails, 'cloud': emails})
+        ego_client = EgoClient(base_url, MockRestClient(server, base_url))
+        if preload:
+            ego_client.load_users()
+        client = DacoClient('daco', 'cloud', users, ego_client)
+        assert getattr(client, engine)() == []
+        assert writes(server.request_log) == []
+
+
+def test_folded_emails_keep_their_address():
+    # ß case folds to ss, but ego only finds an account by its own address
+    users = [User("Straße@x.de", "Person S", True, True)]
+    for engine, preload in (('update_ego', True), ('update_ego', False), ('sync', False)):
+        server = MockEgoServer(groups={'daco': ['straße@x.de'], 'cloud': ['straße@x.de']})
+        ego_client = EgoClient(base_url, MockRestClient(server, base_url))
+        if preload:
+            ego_client.load_users()
+        client = DacoClient('daco', 'cloud', users, ego_client)
+        assert getattr(client, engine)() == []
+        assert writes(server.request_log) == []
+
+        # a new one is created with the address it was given
+        server = MockEgoServer(groups={'daco': [], 'cloud': []})
+        client = DacoClient('daco', 'cloud', users, EgoClient(base_url, MockRestClient(server, base_url)))
+        getattr(client, engine)()
+        assert [u['email'] for u in server.users.values()] == ['straße@x.de']
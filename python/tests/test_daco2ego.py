@@ -1,6 +1,10 @@
 #!/usr/bin/env python
-from daco2ego import daco_users_csv_to_list, read_config
-from daco_user import User
+import pytest
+
+import daco2ego
+from daco2ego import daco_users_csv_to_list, daco_users_from_csv, init, make_transport, parse_args, \
+    read_config
+from daco_user import User, email_key, normalize_email
 
 
 def test_read_config():
@@ -37,3 +41,62 @@ def test_users():
     daco = file_to_dict("test_users.csv")
     print(daco)
     assert daco == expected
+
+
+def test_parse_args():
+    options = parse_args([])
+    assert options.config == "config/default.conf"
+    assert not options.plan
+
+    options = parse_args(["--plan", "my.conf"])
+    assert options.config == "my.conf"
+    assert options.plan
+
+
+def test_users_from_stream():
+    with open("tests/test_users.csv", "r") as f:
+        lines = iter(f.read().splitlines())
+
+    users = daco_users_from_csv(lines)
+    first = next(users)
+    assert first == User('dd@example.com', 'DDD LLL', True, True)
+    assert len(list(users)) == 5
+
+
+def test_normalize_email():
+    assert normalize_email(" Dd@Example.COM\t") == "dd@example.com"
+    # case folding is for comparing emails, not for the address itself
+    assert normalize_email("Straße@example.com") == "straße@example.com"
+    assert email_key("STRASSE@example.com") == email_key("straße@example.com")
+
+    users = daco_users_from_csv(["USER NAME,OPENID", "D D, DD@Example.com "])
+    assert [u.email for u in users] == ["dd@example.com"]
+
+
+def test_token_cache_needs_secret():
+    # reported with the other missing entries, by init, not when we make the transport
+    config = {'client': {'token_cache_file': 'tokens'}}
+    transport = make_transport(config)
+    with pytest.raises(KeyError, match='token_cache_secret'):
+        init(config, transport)
+
+
+def test_bookkeeping_failures_dont_fail_the_run(monkeypatch, tmpdir, capsys):
+    from tests.test_daco_client import daco_client
+    sent = []
+
+    class Reporter(object):
+        def __init__(self, url, transport):
+            pass
+
+        def send(self, report):
+            sent.append(report)
+
+    config = {'client': {'metrics_file': str(tmpdir.join("missing", "metrics.json"))},
+              'slack': {'url': ''}}
+    monkeypatch.setattr(daco2ego, 'read_config', lambda path: config)
+    monkeypatch.setattr(daco2ego, 'SlackReporter', Reporter)
+    monkeypatch.setattr(daco2ego, 'init', lambda *args: daco_client()[0])
+    daco2ego.main("daco2ego.py")
+    assert "Can't save metrics" in capsys.readouterr().out
+    assert "*Updates*" in sent[0] and "Run failed" not in "".join(sent)
@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+import time
 from collections import OrderedDict
 
 from daco_client import DacoClient
@@ -412,3 +413,99 @@ def test_update_ego():
 
             assert set(a) == set(e)
         print("ok.")
+
+
+def test_update_ego_with_workers():
+    d, e = daco_client()
+    expected = d.update_ego()
+    expected_summary = d.get_summary()
+
+    for workers in (2, 8):
+        d, e = daco_client()
+        d.workers = workers
+        # same issues, in the same order, as one user at a time
+        assert d.update_ego() == expected
+        assert d.get_summary() == expected_summary
+
+
+def test_update_ego_from_stream():
+    d, e = daco_client()
+    expected = d.update_ego()
+
+    groups = {'users': list(ego.keys()),
+              daco_group: [k for k, v in ego.items() if v[0]],
+              cloud_group: [k for k, v in ego.items() if v[1]]}
+    e2 = MockEgoSuccess(groups)
+    d2 = DacoClient(daco_group, cloud_group, iter(users), e2)
+    issues = d2.update_ego()
+
+    # the whole list is validated before we grant anything, as for a list
+    assert issues == expected
+    assert d2.get_summary() == d.get_summary()
+    assert d2.approved_users() == users
+
+    for group in (daco_group, cloud_group):
+        assert set(e2.groups[group]) == set(e.groups[group])
+
+
+class SlowMembers(MockEgoSuccess):
+    def is_member(self, group, user):
+        member = super(SlowMembers, self).is_member(group, user)
+        time.sleep(0.01)  # so that other workers ask before we answer
+        return member
+
+
+def test_repeated_entries_granted_once():
+    user = User('x@ca', 'Person X', True, False)
+    e = SlowMembers({'users': ['x@ca'], daco_group: [], cloud_group: []})
+    d = DacoClient(daco_group, cloud_group, [user] * 8, e, workers=4)
+    assert d.update_ego() == ["Granted daco to existing user 'x@ca(Person X)'"]
+    assert d.get_summary() == ({'grant_daco': 1}, [])
+    assert e.get_calls()['add'] == [(daco_group, 'x@ca')]
+
+
+def test_stream_duplicates_counted_as_for_a_list():
+    entries = [User('http://openid/x', 'Person A', True, True),
+               User('http://openid/x', 'Person B', True, True),
+               User('y@ca', 'Person A', True, False),
+               User('y@ca', 'Person B', True, False)]
+    for workers in (1, 4):
+        results = []
+        for users_in in (entries, iter(entries)):
+            e = MockEgoSuccess({'users': [], daco_group: [], cloud_group: []})
+            d = DacoClient(daco_group, cloud_group, users_in, e, workers=workers)
+            results.append((d.update_ego(), d.get_summary(), e.get_calls()['create_user']))
+        assert results[0] == results[1]
+
+        counts = results[0][1][0]
+        assert counts['invalid_email'] == 1 and counts['multiple_entries'] == 2
+        assert results[0][2] == [('y@ca', 'Person B')]  # the later entry's name
+
+
+def test_stream_is_read_lazily():
+    read = []
+
+    def stream():
+        for u in users:
+            read.append(u)
+            yield u
+
+    d, e = daco_client()
+    d = DacoClient(daco_group, cloud_group, stream(), e)
+    assert read == []
+    list(d.grant())
+    assert read == users
+
+
+def test_users_are_compact():
+    user = User('A@CA', 'Person A', True, False)
+    assert not hasattr(user, '__dict__')
+    # every entry for an email shares one lower case string
+    assert user.email is User('a@ca', 'Person A', True, True).email
+
+    # and we key our users by it, unless case folding changes it
+    d = DacoClient(daco_group, cloud_group, [user, User('Straße@x.de', 'Person S', True, False)],
+                   MockEgoSuccess({}))
+    keys = list(d._user_map)
+    assert keys[0] is user.email
+    assert keys[1] == 'strasse@x.de'
@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from oauthlib.oauth2 import TokenExpiredError
+
+from ego_cache import GroupIdCache, HashedMembers, UserIdIndex
+from ego_client import EgoClient, split_for_url
+from tests.mock_rest_client import MockEgoServer, MockRestClient, MockResponse
+
+base_url = "https://ego/v1"
+
+
+def ego_client():
+    server = MockEgoServer(groups={'daco': ['a@ca', 'b@ca'],
+                                   'cloud': ['b@ca']},
+                           users=['c@ca'])
+    return EgoClient(base_url, MockRestClient(server, base_url)), server
+
+
+def member_downloads(server):
+    return [c for c in server.calls('GET') if c[1].endswith('/users')
+            and c[1].startswith('/groups/')]
+
+
+def test_membership_snapshot():
+    client, server = ego_client()
+
+    for user in ('a@ca', 'b@ca', 'c@ca'):
+        client.is_member('daco', user)
+        client.is_member('cloud', user)
+    assert client.get_users('daco') == {'a@ca', 'b@ca'}
+    assert client.get_users('cloud') == {'b@ca'}
+
+    # one download per group, no matter how many questions we ask
+    assert len(member_downloads(server)) == 2
+
+
+def test_get_users_returns_copy():
+    client, server = ego_client()
+    users = client.get_users('daco')
+    users.add('x@ca')
+    assert not client.is_member('daco', 'x@ca')
+
+
+def test_invalidate_and_refresh():
+    client, server = ego_client()
+    assert not client.is_member('daco', 'c@ca')
+
+    # someone else changes ego behind our back
+    server.members['g1'].add(server.find_user('c@ca'))
+    assert not client.is_member('daco', 'c@ca')
+
+    client.invalidate('daco')
+    assert client.is_member('daco', 'c@ca')
+
+    server.members['g1'].clear()
+    assert client.refresh('daco') == set()
+    assert not client.is_member('daco', 'a@ca')
+
+
+def test_snapshot_follows_our_changes():
+    client, server = ego_client()
+    assert not client.is_member('cloud', 'a@ca')
+
+    client.add('cloud', ['a@ca'])
+    assert client.is_member('cloud', 'a@ca')
+
+    client.remove('daco', ['b@ca'])
+    assert not client.is_member('daco', 'b@ca')
+    assert client.get_users('daco') == {'a@ca'}
+    assert len(member_downloads(server)) == 2
+
+
+def test_failed_change_invalidates():
+    client, server = ego_client()
+    assert client.is_member('daco', 'a@ca')
+
+    rest = client._rest_client
+    rest.delete = lambda url, **kwargs: MockResponse(url, 500, "oops")
+    try:
+        client.remove('daco', ['a@ca'])
+    except IOError:
+        pass
+    else:
+        assert False, "remove should report the failed DELETE"
+
+    # We can't know what ego did, so the next question goes back to ego
+    assert client.is_member('daco', 'a@ca')
+    assert len(member_downloads(server)) == 2
+
+
+def test_cache_stats():
+    client, server = ego_client()
+    client.is_member('daco', 'a@ca')
+    client.is_member('daco', 'b@ca')
+    client.get_users('daco')
+    client.add('daco', ['c@ca'])
+    client.refresh('daco')
+
+    assert client.cache_stats() == {'hits': 2, 'misses': 1, 'refreshes': 1}
+
+
+def user_searches(server):
+    return [c for c in server.calls('GET') if c[1] == '/users']
+
+
+def test_user_ids_are_memoized():
+    client, server = ego_client()
+    for _ in range(3):
+        assert client.user_exists('a@ca')
+        assert not client.user_exists('nobody@ca')
+    client.add('cloud', ['a@ca'])
+    client.remove('cloud', ['a@ca'])
+
+    # one search for a@ca, one for the (negative) entry for nobody@ca
+    assert len(user_searches(server)) == 2
+
+
+def test_load_users():
+    client, server = ego_client()
+    client.page_size = 2
+    assert client.load_users() == 3
+    assert len(user_searches(server)) == 2  # two pages of two
+
+    assert client.user_exists('c@ca')
+    assert not client.user_exists('nobody@ca')
+    client.add('daco', ['c@ca'])
+    assert len(user_searches(server)) == 2
+
+
+def test_created_user_is_found():
+    client, server = ego_client()
+    client.load_users()
+    assert not client.user_exists('new@ca')
+
+    client.create_user('new@ca', 'New User')
+    assert client.user_exists('new@ca')
+    client.add('daco', ['new@ca'])
+    assert server.group_emails('daco') == {'a@ca', 'b@ca', 'new@ca'}
+
+
+def test_created_user_id_is_reused():
+    # ego's search index can lag behind; we shouldn't need it for new users
+    client, server = ego_client()
+    created = client.create_user('New@ca', 'New User')
+    client.add('daco', ['new@ca'])
+    client.add('cloud', ['new@ca'])
+    assert user_searches(server) == []
+    assert all(created['id'] in members for members in server.members.values())
+
+
+def group_searches(server):
+    return [c for c in server.calls('GET') if c[1] == '/groups']
+
+
+def test_group_ids_are_cached():
+    client, server = ego_client()
+    client.get_users('daco')
+    client.add('daco', ['c@ca'])
+    client.remove('daco', ['c@ca'])
+    client.refresh('daco')
+    assert len(group_searches(server)) == 1
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_group_id_ttl(tmp_path):
+    clock = Clock()
+    path = str(tmp_path / "groups.json")
+    cache = GroupIdCache(ttl=60, path=path, clock=clock)
+    lookups = []
+
+    def resolve(group):
+        lookups.append(group)
+        return group.upper()
+
+    assert cache.get('daco', resolve) == 'DACO'
+    clock.now += 59
+    assert cache.get('daco', resolve) == 'DACO'
+    assert lookups == ['daco']
+
+    clock.now += 1
+    assert cache.get('daco', resolve) == 'DACO'
+    assert lookups == ['daco', 'daco']
+
+    # the next run picks up where we left off
+    cache2 = GroupIdCache(ttl=60, path=path, clock=clock)
+    assert cache2.get('daco', resolve) == 'DACO'
+    assert lookups == ['daco', 'daco']
+
+
+def test_unreadable_group_id_cache(tmp_path):
+    path = tmp_path / "groups.json"
+    path.write_text("not json")
+    cache = GroupIdCache(path=str(path))
+    assert cache.get('daco', lambda g: 'g1') == 'g1'
+    assert GroupIdCache(path=str(path)).get('daco', None) == 'g1'
+
+
+def test_stale_group_id_is_dropped(tmp_path):
+    calls = (lambda client: client.add('daco', ['c@ca']),
+             lambda client: client.remove('daco', ['a@ca']),
+             lambda client: client.get_users('daco'),
+             lambda client: client.group_size('daco'))
+    for number, call in enumerate(calls):
+        path = str(tmp_path / f"groups{number}.json")
+        client, server = ego_client()
+        client._group_ids = GroupIdCache(path=path)
+        client.get_users('daco')
+
+        # the group is deleted and made again, under a new id
+        old_id = client._group_id('daco')
+        server.members[server.create_group('daco')] = server.members.pop(old_id)
+        del server.groups[old_id]
+
+        # the next run's first call finds our persisted id is stale
+        client = EgoClient(base_url, MockRestClient(server, base_url), group_ids=GroupIdCache(path=path))
+        try:
+            call(client)
+        except IOError:
+            pass
+        else:
+            assert False, "ego should have no group with our old id"
+        assert 'daco' not in GroupIdCache(path=path)._ids
+
+        call(client)
+        assert GroupIdCache(path=path)._ids['daco'][0] != old_id
+
+
+def test_split_for_url():
+    assert list(split_for_url([], 10)) == []
+    assert list(split_for_url(['aaa', 'bbb', 'ccc'], 7)) == [['aaa', 'bbb'], ['ccc']]
+    assert list(split_for_url(['aaaaaaaaaa', 'b'], 3)) == [['aaaaaaaaaa'], ['b']]
+
+
+def test_remove_splits_long_urls():
+    client, server = ego_client()
+    client.add('cloud', ['a@ca', 'c@ca'])
+    # room for exactly two ids in the url
+    client.max_url_length = len(base_url + "/groups/g2/users/") + len("u1,u2")
+    client.remove('cloud', ['a@ca', 'b@ca', 'c@ca'])
+
+    assert len(server.calls('DELETE')) == 2
+    assert server.group_emails('cloud') == set()
+    assert client.get_users('cloud') == set()
+
+
+def test_one_token_refresh_for_many_threads():
+    server = MockEgoServer(groups={'daco': ['a@ca']})
+    expired = MockRestClient(server, base_url)
+    barrier = threading.Barrier(8)
+
+    def get_expired(url, **kwargs):
+        barrier.wait()  # everyone sees the expired token at once
+        raise TokenExpiredError()
+
+    expired.get = get_expired
+    refreshes = []
+
+    def new_client():
+        refreshes.append(1)
+        return MockRestClient(server, base_url)
+
+    client = EgoClient(base_url, expired, new_client)
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda _: client._get_json("/groups?name=daco"),
+                                range(8)))
+
+    assert len(refreshes) == 1
+    assert all(r['count'] == 1 for r in results)
+
+
+def test_paged_group_download():
+    emails = [f"user{i}@ca" for i in range(11)]
+    server = MockEgoServer(groups={'daco': emails})
+    client = EgoClient(base_url, MockRestClient(server, base_url), page_size=3)
+
+    assert client.get_users('daco') == set(emails)
+    pages = [q for m, p, q in server.query_log if p == '/groups/g1/users']
+    assert sorted(int(q['offset'][0]) for q in pages) == [0, 3, 6, 9]
+    assert all(q['limit'] == ['3'] for q in pages)
+
+    users = client.iter_users('daco')
+    first = next(users)
+    rest = list(users)
+    assert len(rest) == 10
+    assert set(rest) | {first} == set(emails)
+
+
+def test_single_page_download():
+    client, server = ego_client()
+    assert client.get_users('daco') == {'a@ca', 'b@ca'}
+    assert len(member_downloads(server)) == 1
+
+
+def test_hashed_members():
+    members = HashedMembers(lambda: ['a@ca', 'B@ca'])
+    assert 'a@ca' in members and 'b@ca' in members and 'A@CA' in members
+    assert 'c@ca' not in members
+    assert len(members) == 2
+
+    members.update(['c@ca', 'a@ca'])
+    members.difference_update(['b@ca', 'd@ca'])
+    assert len(members) == 2
+    assert 'c@ca' in members and 'b@ca' not in members
+
+
+def test_hashed_members_share_a_hash(monkeypatch):
+    import ego_cache
+    monkeypatch.setattr(ego_cache, 'email_hash', lambda email: len(email))
+    fetches = []
+
+    def fetch():
+        fetches.append(1)
+        return ['a@ca', 'b@ca', 'cc@ca']
+
+    members = HashedMembers(fetch)
+    assert len(fetches) == 2  # once more, for the emails of the shared hash
+    assert 'a@ca' in members and 'b@ca' in members
+    assert 'x@ca' not in members  # same hash, but compared exactly
+    assert 'xx@ca' in members  # a collision with a hash only one member has
+
+    members.difference_update(['x@ca'])
+    assert len(members) == 3
+    members.difference_update(['a@ca'])
+    assert 'a@ca' not in members and 'b@ca' in members
+
+    # a new member with the shared hash
+    members.update(['y@ca'])
+    assert 'y@ca' in members and len(members) == 3
+
+
+def test_hashed_membership_snapshot():
+    server = MockEgoServer(groups={'daco': ['a@ca', 'b@ca']}, users=['c@ca'])
+    client = EgoClient(base_url, MockRestClient(server, base_url), hashed_members=True)
+
+    assert client.is_member('daco', 'a@ca') and not client.is_member('daco', 'c@ca')
+    client.add('daco', ['c@ca'])
+    client.remove('daco', ['a@ca'])
+    assert client.is_member('daco', 'c@ca') and not client.is_member('daco', 'a@ca')
+    assert len(member_downloads(server)) == 1
+
+    # a hashed snapshot can't list the members, so they're downloaded again
+    assert client.get_users('daco') == {'b@ca', 'c@ca'}
+    assert len(member_downloads(server)) == 2
+
+
+def test_user_id_index():
+    index = UserIdIndex()
+    assert index.get('a@ca') is None
+    index.load([{'email': 'A@ca', 'id': 'u1'}, {'email': 'b@ca', 'id': 'u2'},
+                {'email': 'a@CA', 'id': 'u3'}])
+    assert index.get('a@ca') == ['u1', 'u3']
+    assert index.get('b@ca') == ['u2']
+    assert index.get('c@ca') == []
+    assert index.emails() == {'a@ca', 'b@ca'} and len(index) == 2
+
+    index.put('c@ca', ['u4'])
+    index.forget('b@ca')
+    assert index.get('c@ca') == ['u4'] and index.get('b@ca') is None
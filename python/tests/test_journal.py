@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+import os
+
+import pytest
+
+from daco2ego import parse_args
+from daco_client import DacoClient
+from daco_user import User
+from ego_client import EgoClient
+from journal import ADD, CREATE, Journal, confirmed, read
+from tests.mock_rest_client import MockEgoServer, MockRestClient
+from tests.test_daco_client import daco_client, daco_group, cloud_group, users
+
+
+def journaled_run(path, resume=False, engine='update_ego', batch_size=None):
+    _, e = daco_client()
+    journal = Journal(str(path))
+    journal.start(resume)
+    d = DacoClient(daco_group, cloud_group, users, e, batch_size=batch_size, journal=journal)
+    issues = getattr(d, engine)()
+    return d, e, journal, issues
+
+
+def test_changes_are_journaled(tmpdir):
+    path = tmpdir.join("journal")
+    for engine, batch_size in (('update_ego', None), ('sync', None), ('sync', 2)):
+        d, e, journal, _ = journaled_run(path, engine=engine, batch_size=batch_size)
+        journal.close()
+
+        records = [r for r in read(str(path)) if r['run'] == journal.run]
+        assert records[0]['event'] == 'start'
+        planned = [r for r in records if r['event'] == 'planned']
+        assert [r['event'] for r in records[1:]] == ['planned', 'done'] * len(planned)
+        assert sum(len(r['users']) for r in planned if r['op'] == CREATE) == 2
+        # every ego call we made is in the journal, in order
+        made = [(r['op'], r['group'], len(r['users'])) for r in planned if r['op'] != CREATE]
+        assert made == e.batches
+
+
+def test_failures_are_journaled(tmpdir):
+    path = str(tmpdir.join("journal"))
+    journal = Journal(path)
+    journal.start()
+    with pytest.raises(ValueError):
+        with journal.record(ADD, 'daco', ['a@ca']):
+            raise ValueError("ego said no")
+    journal.close()
+    assert [(r['event'], r.get('error')) for r in read(path)[1:]] == \
+           [('planned', None), ('failed', "ego said no")]
+    assert confirmed(read(path)) == {}
+
+
+def test_resume_redoes_changes_ego_lacks(tmpdir):
+    path = tmpdir.join("journal")
+    # a run that died after granting daco access to a@ca
+    journal = Journal(str(path))
+    journal.start()
+    with journal.record(ADD, daco_group, ['a@ca']):
+        pass
+    with journal.record(ADD, cloud_group, ['aa@ca']):
+        pass  # dies before ego answers
+    journal._file.close()
+    with open(str(path)) as f:
+        lines = f.readlines()
+    with open(str(path), "w") as f:
+        f.writelines(lines[:-1] + [lines[-1][:10]])  # half written
+    assert confirmed(read(str(path))) == {(ADD, daco_group, 'a@ca'): None}
+
+    # ego doesn't have the grant the journal says was made, so we make it again
+    _, expected, _, expected_issues = journaled_run(tmpdir.join("other"))
+    for engine in ('update_ego', 'sync'):
+        d, e, journal, issues = journaled_run(path, resume=True, engine=engine)
+        assert issues == expected_issues
+        assert e.get_calls()['add'] == expected.get_calls()['add']
+        assert d.get_summary() == expected_summary(engine)
+        journal.close()
+
+
+def expected_summary(engine):
+    _, e = daco_client()
+    d = DacoClient(daco_group, cloud_group, users, e)
+    getattr(d, engine)()
+    return d.get_summary()
+
+
+class LaggingEgoServer(MockEgoServer):
+    """ An ego whose search doesn't find the users in unindexed yet """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.unindexed = set()
+
+    def _search(self, items, query, field):
+        items = super()._search(items, query, field)
+        return [i for i in items if i.get('id') not in self.unindexed]
+
+
+def test_resume_reuses_created_users(tmpdir):
+    base_url = "https://ego/v1"
+    new_user = User("new@example.com", "New User", True, True)
+    for engine in ('update_ego', 'sync'):
+        path = str(tmpdir.join(engine))
+        server = LaggingEgoServer(groups={'daco': [], 'cloud': []})
+        # a run that died after creating the user, before granting them access
+        journal = Journal(path)
+        journal.start()
+        client = DacoClient('daco', 'cloud', [new_user],
+                            EgoClient(base_url, MockRestClient(server, base_url)), journal=journal)
+        client.create_user(new_user)
+        journal.close()
+        user_id = server.find_user(new_user.email)
+        server.unindexed.add(user_id)
+        server.request_log.clear()
+
+        journal = Journal(path)
+        journal.start(resume=True)
+        client = DacoClient('daco', 'cloud', [new_user],
+                            EgoClient(base_url, MockRestClient(server, base_url)), journal=journal)
+        getattr(client, engine)()
+        journal.close()
+        assert ('POST', '/users') not in server.request_log, engine
+        assert server.group_emails('daco') == server.group_emails('cloud') == {new_user.email}
+        assert len(server.users) == 1
+
+
+def test_fsync_in_batches(tmpdir, monkeypatch):
+    syncs = []
+    monkeypatch.setattr(os, 'fsync', syncs.append)
+    journal = Journal(str(tmpdir.join("journal")), sync_every=10)
+    journal.start()
+    assert len(syncs) == 1  # the start of a run is on disk before we change anything
+    for i in range(12):
+        with journal.record(ADD, 'daco', [f"{i}@ca"]):
+            pass
+    assert len(syncs) == 3
+    journal.finish({}, [])
+    assert len(syncs) == 4
+    journal.close()
+    assert len(syncs) == 4
+
+
+def test_resume_option():
+    assert parse_args(["--resume"]).resume
+    assert not parse_args([]).resume
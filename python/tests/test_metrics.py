@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+from ego_client import EgoClient
+from metrics import Metrics, endpoint_name, percentile
+from report import create
+from tests.mock_rest_client import MockEgoServer, MockRestClient
+from tests.test_daco_client import daco_client
+
+base_url = "https://ego/v1"
+
+
+def test_endpoint_name():
+    assert endpoint_name('ego', 'GET', "/groups?name=daco") == "ego GET /groups"
+    assert endpoint_name('ego', 'GET', "/groups/g1/users?offset=0&limit=10") == \
+        "ego GET /groups/{id}/users"
+    assert endpoint_name('ego', 'DELETE', "/groups/g1/users/u1,u2") == \
+        "ego DELETE /groups/{id}/users/{id}"
+
+
+def test_percentile():
+    latencies = list(range(1, 101))
+    assert percentile(latencies, 50) == 50
+    assert percentile(latencies, 95) == 95
+    assert percentile(latencies, 99) == 99
+    assert percentile([7], 99) == 7
+    assert percentile([], 50) is None
+
+
+def test_phases():
+    now = [0.0]
+    metrics = Metrics(clock=lambda: now[0])
+    with metrics.phase('grant'):
+        now[0] += 2
+    with metrics.phase('revoke'):
+        now[0] += 1
+    with metrics.phase('grant'):
+        now[0] += 0.5
+    assert metrics.phases() == {'grant': 2.5, 'revoke': 1}
+
+
+def test_ego_requests_recorded():
+    server = MockEgoServer(groups={'daco': ['a@ca', 'b@ca']}, users=['c@ca'])
+    client = EgoClient(base_url, MockRestClient(server, base_url))
+    client.get_users('daco')
+    client.add('daco', ['c@ca'])
+    try:
+        client.create_user('a@ca', "Person A")
+    except IOError:
+        pass
+
+    endpoints = client.metrics.endpoints()
+    assert set(endpoints) == {"ego GET /groups", "ego GET /groups/{id}/users",
+                              "ego GET /users", "ego POST /groups/{id}/users",
+                              "ego POST /users"}
+    members = endpoints["ego GET /groups/{id}/users"]
+    assert members['requests'] == 1 and members['errors'] == 0
+    assert members['bytes'] > 0
+    assert members['p50'] <= members['p95'] <= members['p99']
+    assert client.read_latency() == client.metrics.mean_latency('ego GET ')
+
+
+def test_phases_of_a_run():
+    d, e = daco_client()
+    d.update_ego()
+    assert list(d.metrics.phases()) == ['grant', 'revoke']
+
+    d, e = daco_client()
+    d.sync()
+    assert list(d.metrics.phases()) == ['download', 'apply']
+
+
+def test_performance_report():
+    performance = {'phases': {'download': 1.25, 'grant': 3},
+                   'endpoints': {"ego GET /groups/{id}/users": {
+                       'requests': 4, 'errors': 0, 'bytes': 4096, 'seconds': 0.5,
+                       'p50': 0.1, 'p95': 0.15, 'p99': 0.2}}}
+    report = create({}, [], True, performance)
+    assert report.endswith("*Performance*:\n"
+                           "\tdownload 1.2s, grant 3.0s\n"
+                           "\tego GET /groups/{id}/users: 4 requests, 4KB, "
+                           "p50 100ms, p95 150ms, p99 200ms\n"
+                           "\tTotal: 4 requests, 0.5s waiting for responses\n")
+    assert "*Performance*" not in create({}, [], True)
+    assert "*Performance*" not in create({}, ["Error"], False, performance)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+import logging
+import pstats
+from contextlib import contextmanager
+
+import daco2ego
+from daco2ego import configure_logging, parse_args
+from profiling import StackSampler, profile
+from tests.test_daco_client import daco_client
+
+
+def busy():
+    return sorted(str(i) for i in range(10000))
+
+
+def test_profile(tmpdir):
+    with profile(str(tmpdir)):
+        busy()
+
+    stats = pstats.Stats(str(tmpdir.join("daco2ego.pstats")))
+    assert any(name == 'busy' for _, _, name in stats.stats)
+    memory = tmpdir.join("daco2ego.memory.txt").read()
+    assert memory.startswith("Peak traced memory: ")
+    assert "Top 25 allocation sites:\n" in memory
+
+
+def test_nothing_to_do(tmpdir):
+    with profile():
+        busy()
+    assert tmpdir.listdir() == []
+
+
+def test_stack_snapshot():
+    sampler = StackSampler(60)
+    assert "in test_stack_snapshot\n" in sampler.snapshot()
+
+
+def test_sampling(caplog):
+    caplog.set_level(logging.INFO)
+    with profile(sample_interval=0.01):
+        while not any("Stack snapshot" in r.message for r in caplog.records):
+            busy()
+    assert "Thread MainThread:\n" in caplog.text
+
+
+def test_logging_configured():
+    # the snapshots are logged at INFO, which isn't shown by default
+    root = logging.getLogger()
+    level = root.level
+    try:
+        root.setLevel(logging.WARNING)
+        configure_logging(parse_args([]))
+        assert not root.isEnabledFor(logging.INFO)
+        for args in (["--sample", "5"], ["--profile"]):
+            root.setLevel(logging.WARNING)
+            configure_logging(parse_args(args))
+            assert root.isEnabledFor(logging.INFO), args
+    finally:
+        root.setLevel(level)
+
+
+def test_profile_options():
+    options = parse_args(["my.conf", "--profile", "--sample", "5"])
+    assert options.config == "my.conf"
+    assert options.profile and options.profile_dir == "profile"
+    assert options.sample == 5
+
+    # the config file isn't taken for a directory, whichever order they come in
+    options = parse_args(["--profile", "prod.conf"])
+    assert options.profile and options.config == "prod.conf"
+
+    options = parse_args(["--profile", "--profile-dir", "out"])
+    assert options.profile_dir == "out" and options.sample is None
+    assert not parse_args([]).profile
+
+
+def test_profile_not_saved(tmpdir, caplog):
+    # a profile we can't save is logged, rather than failing the run
+    with profile(str(tmpdir)):
+        tmpdir.join("daco2ego.pstats").mkdir()
+    assert "Can't save the profile" in caplog.text
+
+
+def test_profile_includes_init(monkeypatch):
+    profiled = []
+
+    @contextmanager
+    def recording_profile(directory=None, sample_interval=None):
+        profiled.append('start')
+        yield
+        profiled.append('stop')
+
+    def init(*args):
+        profiled.append('init')
+        return daco_client()[0]
+
+    monkeypatch.setattr(daco2ego, 'read_config', lambda path: {'client': {}, 'slack': {'url': ''}})
+    monkeypatch.setattr(daco2ego, 'send_summary', lambda *args: None)
+    monkeypatch.setattr(daco2ego, 'profile', recording_profile)
+    monkeypatch.setattr(daco2ego, 'init', init)
+    daco2ego.main("daco2ego.py", "--profile")
+    assert profiled == ['start', 'init', 'stop']
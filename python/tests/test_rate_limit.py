@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+import json
+import threading
+
+from requests import Response
+from requests.adapters import BaseAdapter
+
+from rate_limit import AdaptiveLimiter, backoff, retry_after
+from transport import Transport
+
+
+class FlakyAdapter(BaseAdapter):
+    """ Answers with the given status codes in turn, then with 200s """
+
+    def __init__(self, *statuses, headers=None):
+        super(FlakyAdapter, self).__init__()
+        self.statuses = list(statuses)
+        self.headers = headers or {}
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request.method)
+        r = Response()
+        r.status_code = self.statuses.pop(0) if self.statuses else 200
+        if r.status_code != 200:
+            r.headers.update(self.headers)
+        r.url = request.url
+        r.request = request
+        r._content = json.dumps({}).encode()
+        return r
+
+    def close(self):
+        pass
+
+
+def transport(adapter, **kwargs):
+    waits = []
+    t = Transport(sleep=waits.append, **kwargs)
+    t.session.mount("https://ego", adapter)
+    return t, waits
+
+
+def test_retry_after():
+    r = Response()
+    assert retry_after(r) is None
+    r.headers['Retry-After'] = "7"
+    assert retry_after(r) == 7
+    r.headers['Retry-After'] = "Wed, 21 Oct 2015 07:28:00 GMT"
+    assert retry_after(r, now=1445412470) == 10
+    r.headers['Retry-After'] = "soon"
+    assert retry_after(r) is None
+
+
+def test_backoff():
+    for attempt in range(10):
+        assert 0 <= backoff(attempt, base=1, cap=8) <= min(8, 2 ** attempt)
+
+
+def test_reads_retried():
+    t, waits = transport(FlakyAdapter(503, 502))
+    r = t.request('GET', "https://ego/v1/groups")
+    assert r.status_code == 200
+    assert len(waits) == 2
+    assert t.metrics.count('http GET') == 3
+    assert t.limiter.throttled == 2
+
+
+def test_retry_after_honoured():
+    now = [100.0]
+    limiter = AdaptiveLimiter(clock=lambda: now[0])
+    t, waits = transport(FlakyAdapter(429, headers={'Retry-After': "5"}), limiter=limiter)
+    t._sleep = lambda seconds: (waits.append(seconds), now.__setitem__(0, now[0] + seconds))
+    assert t.request('GET', "https://ego/v1/groups").ok
+    assert waits == [5]
+
+
+def test_gives_up_after_retries():
+    t, waits = transport(FlakyAdapter(503, 503, 503), retries=2)
+    assert t.request('GET', "https://ego/v1/groups").status_code == 503
+    assert len(waits) == 2
+
+
+def test_writes_only_retried_when_turned_away():
+    adapter = FlakyAdapter(503, 429)
+    t, waits = transport(adapter)
+    # ego may have acted on the POST that got a 503, so we don't resend it
+    assert t.request('POST', "https://ego/v1/users").status_code == 503
+    # but it hasn't acted on one it turned away with a 429
+    assert t.request('POST', "https://ego/v1/users").ok
+    assert adapter.requests == ['POST', 'POST', 'POST']
+
+
+def test_limiter_adapts():
+    limiter = AdaptiveLimiter(maximum=8, target_latency=1)
+    limiter.acquire()
+    limiter.release(0.1, overloaded=True)
+    assert limiter.limit == 4
+    limiter.acquire()
+    limiter.release(2)  # slow
+    assert limiter.limit == 3.6
+    for _ in range(100):
+        limiter.acquire()
+        limiter.release(0.1)
+    assert limiter.limit == 8
+    for _ in range(10):
+        limiter.acquire()
+        limiter.release(0.1, overloaded=True)
+    assert limiter.limit == 1
+
+
+def test_limiter_limits():
+    limiter = AdaptiveLimiter(maximum=2)
+    limiter.acquire()
+    limiter.acquire()
+    acquired = threading.Event()
+
+    def third():
+        limiter.acquire()
+        acquired.set()
+
+    threading.Thread(target=third).start()
+    assert not acquired.wait(0.1)
+    limiter.release(0.1)
+    assert acquired.wait(1)
+    assert limiter.in_flight == 2
+
+
+def test_limiter_pause():
+    now = [100.0]
+    limiter = AdaptiveLimiter(maximum=2, clock=lambda: now[0])
+    limiter.pause(5)
+    acquired = threading.Event()
+
+    def acquire():
+        limiter.acquire()
+        acquired.set()
+
+    threading.Thread(target=acquire).start()
+    assert not acquired.wait(0.1)
+    now[0] += 5
+    with limiter._condition:
+        limiter._condition.notify_all()
+    assert acquired.wait(1)
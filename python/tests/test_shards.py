@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+from collections import Counter
+
+import pytest
+
+from daco2ego import parse_args
+from daco_client import DacoClient
+from shards import Shard, merge_results, save_result
+from tests.test_daco_client import daco_client, daco_group, cloud_group, users
+
+
+def test_parse():
+    shard = Shard.parse("1/4")
+    assert (shard.index, shard.count) == (1, 4)
+    assert str(shard) == "1/4"
+    for spec in ("4/4", "-1/4", "1", "a/b", "0/0"):
+        with pytest.raises(ValueError):
+            Shard.parse(spec)
+
+
+def test_shards_partition_users():
+    emails = [f"user{i}@example.com" for i in range(1000)]
+    shards = [Shard(i, 4) for i in range(4)]
+    sizes = [sum(1 for e in emails if e in s) for s in shards]
+    assert sum(sizes) == len(emails)
+    assert all(200 < size < 300 for size in sizes)
+
+    # the same shard whichever way the email is written
+    for s in shards:
+        assert ("User1@Example.com " in s) == ("user1@example.com" in s)
+
+
+def test_select():
+    shard = Shard(0, 3)
+    selected = shard.select(users)
+    assert selected == [u for u in users if u.email in shard]
+    assert list(shard.select(iter(users))) == selected
+
+
+def sharded_run(engine, count, stream=False):
+    issues, counts = [], Counter()
+    for index in range(count):
+        # every shard starts from the same state of ego
+        _, e = daco_client()
+        d = DacoClient(daco_group, cloud_group, iter(users) if stream else users, e,
+                       shard=Shard(index, count))
+        issues += getattr(d, engine)()
+        counts.update(d.get_summary()[0])
+    return issues, dict(counts)
+
+
+def test_shards_cover_the_whole_run():
+    # between them, the shards do what one process would, and no shard
+    # revokes access for users in the others
+    for engine in ('update_ego', 'sync'):
+        for stream in (False, True):
+            _, e = daco_client()
+            d = DacoClient(daco_group, cloud_group, iter(users) if stream else users, e)
+            expected = getattr(d, engine)()
+            expected_counts = d.get_summary()[0]
+            for count in (2, 3, 5):
+                issues, counts = sharded_run(engine, count, stream)
+                assert sorted(issues) == sorted(expected), (engine, stream, count)
+                assert counts == expected_counts
+
+
+def test_merge_results(tmpdir):
+    directory = str(tmpdir)
+    save_result(directory, Shard(0, 3), {'new_daco': 1, 'grant_cloud': 2}, [], ["a", "b"], True)
+    save_result(directory, Shard(2, 3), {'new_daco': 3}, ["*Error:* x"], ["c"], True)
+
+    counts, errors, issues, ran = merge_results(directory, 3)
+    assert counts == {'new_daco': 4, 'grant_cloud': 2}
+    assert errors[0].startswith("*Error:* No result from shard 1/3")
+    assert errors[1:] == ["*Error:* x"]
+    assert issues == ["a", "b", "c"]
+    assert ran
+
+    # the results are only reported once
+    counts, errors, issues, ran = merge_results(directory, 3)
+    assert (counts, issues, ran) == ({}, [], False)
+    assert len(errors) == 3
+
+
+def test_shard_options():
+    options = parse_args(["--shard", "2/8"])
+    assert (options.shard.index, options.shard.count) == (2, 8)
+    assert options.merge is None
+    assert parse_args(["--merge", "8"]).merge == 8
+    with pytest.raises(SystemExit):
+        parse_args(["--shard", "8/8"])
+    with pytest.raises(SystemExit):
+        parse_args(["--shard", "0/8", "--merge", "8"])
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+from daco_client import DacoClient
+from daco_user import User
+from state_store import StateStore, sync_incremental, users_hash
+from tests.test_daco_client import cloud_group, daco_client, daco_group, users
+
+
+def run(store, users, e, force_full=False, full_interval=3600, engine='update_ego'):
+    d = DacoClient(daco_group, cloud_group, users, e)
+    full_runs = []
+
+    def full_sync():
+        full_runs.append(1)
+        return getattr(d, engine)()
+
+    e.call_log.clear()
+    issues = sync_incremental(d, store, full_sync, force_full, full_interval)
+    return issues, bool(full_runs), e.get_calls()
+
+
+def per_user_calls(calls):
+    return {k: v for k, v in calls.items() if k != 'group_size'}
+
+
+def test_incremental_runs(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    _, e = daco_client()
+
+    issues, full, _ = run(store, users, e)
+    assert full and issues
+
+    # nothing has changed: we only ask ego for the group sizes
+    issues, full, calls = run(store, users, e)
+    assert not full and issues == []
+    assert per_user_calls(calls) == {}
+
+    # f@ca gets cloud access, g@ca is no longer approved
+    changed = [u for u in users if u.email != 'g@ca']
+    changed[changed.index(users[7])] = User('f@ca', 'Person F', True, True)
+    issues, full, calls = run(store, changed, e)
+    assert not full
+    assert issues == ["Warning: User 'b@ca(Person B)' has multiple entries "
+                      "in the daco file!",
+                      "Warning: User 'c@ca(Person C)' is invalid (in cloud "
+                      "file, but not in DACO)",
+                      "Granted cloud to existing user 'f@ca(Person F)",
+                      "Warning: User 'http://k.ca/openid/letmein(Person K)' "
+                      "does not have a valid email address",
+                      "Revoked all access for user 'g@ca(None)'"]
+    assert calls['user_exists'] == ['f@ca']
+    assert set(e.groups[cloud_group]) == {'aa@ca', 'b@ca', 'e@ca', 'f@ca'}
+    store.close()
+
+
+def test_full_runs(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    _, e = daco_client()
+    run(store, users, e)
+
+    assert run(store, users, e, force_full=True)[1]
+    assert run(store, users, e, full_interval=-1)[1]
+
+    # someone else changed the groups
+    e.groups[daco_group].append('z@ca')
+    issues, full, _ = run(store, users, e)
+    assert full
+    assert "Revoked all access for user 'z@ca(None)'" in issues
+    assert not run(store, users, e)[1]
+
+
+def test_state_kept_after_errors(tmp_path):
+    store = StateStore(str(tmp_path / "state.db"))
+    _, e = daco_client()
+    run(store, users, e)
+    saved = store.load()
+
+    changed = users + [User('new@ca', 'Person New', True, False)]
+    create_user = e.create_user
+
+    def fail(*args):
+        raise IOError("ego is down")
+
+    e.create_user = fail
+    issues, full, _ = run(store, changed, e)
+    assert "Error: Can't create user 'new@ca(Person New)' -- " \
+           "OSError(ego is down)" in issues
+    assert store.load().export_hash == saved.export_hash
+
+    e.create_user = create_user
+    issues, full, _ = run(store, changed, e)
+    assert issues[-1] == "Created user 'new@ca(Person New)' with daco access"
+    assert store.load().export_hash == users_hash(changed)
+
+
+def test_state_kept_when_ego_cant_be_read(tmp_path):
+    # the next run does the work, rather than finding nothing has changed
+    for engine, method in (('sync', 'all_users'), ('update_ego', 'get_users')):
+        store = StateStore(str(tmp_path / f"{engine}.db"))
+        _, e = daco_client()
+        changed = users + [User('new@ca', 'Person New', True, False)]
+
+        def fail(*args):
+            raise IOError("ego is down")
+
+        setattr(e, method, fail)
+        issues, full, _ = run(store, changed, e, engine=engine)
+        assert full and any(i.startswith("Error: Can't get") for i in issues)
+        assert store.load() is None
+
+        delattr(e, method)
+        issues, full, _ = run(store, changed, e, engine=engine)
+        assert full and issues
+        assert 'new@ca' in e.groups[daco_group]
+        assert store.load().export_hash == users_hash(changed)
+        store.close()
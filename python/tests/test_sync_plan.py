@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+import daco2ego
+from daco2ego import show_plan
+from daco_client import DacoClient
+from daco_user import User
+from report import create_plan
+from sync_plan import make_plan, Plan, CLOUD, DACO
+from tests.test_daco_client import daco_client, daco_group, cloud_group, ego, users
+
+
+def plan():
+    return make_plan(users, set(ego.keys()),
+                     {k for k, v in ego.items() if v[0]},
+                     {k for k, v in ego.items() if v[1]})
+
+
+def test_plan_matches_scenarios():
+    # The plan must report exactly what the per user scenarios report
+    d, e = daco_client()
+    expected_issues = d.update_ego()
+    expected_counts, _ = d.get_summary()
+
+    p = plan()
+    assert set(c.message for c in p) == set(expected_issues)
+    assert p.counts() == expected_counts
+
+
+def test_plan_changes():
+    p = plan()
+    assert [u.email for u in p.creates] == ['d@ca', 'e@ca']
+    assert p.daco_adds == ['a@ca', 'aa@ca', 'd@ca', 'e@ca']
+    assert p.cloud_adds == ['aa@ca', 'b@ca', 'e@ca']
+    assert p.daco_removes == ['i@ca', 'j@ca']
+    assert p.cloud_removes == ['c@ca', 'h@ca', 'j@ca', 'k@ca']
+
+
+def test_plan_ignores_case_and_repeats():
+    u = User('X@ca', 'Person X', True, True)
+    p = make_plan([u, u], {'x@CA'}, {'X@ca'}, set())
+    assert [(c.category, c.add) for c in p] == [('grant_cloud', (CLOUD,))]
+
+    p = make_plan([], {'x@CA'}, {'X@ca'}, set())
+    assert [(c.category, c.remove) for c in p] == [('revoke_daco', (DACO,))]
+
+
+def test_plan_counts_repeated_rejects():
+    # exact repeats of a rejected entry are each counted, as update_ego counts them
+    for user, category in ((User('not an email', 'Person X', True, True), 'invalid_email'),
+                           (User('x@ca', 'Person X', False, True), 'invalid')):
+        _, e = daco_client()
+        d = DacoClient(daco_group, cloud_group, [user, user], e)
+        d.update_ego()
+        expected_counts, _ = d.get_summary()
+        p = make_plan([user, user], set(ego.keys()),
+                      {k for k, v in ego.items() if v[0]},
+                      {k for k, v in ego.items() if v[1]})
+        assert p.counts() == expected_counts
+        assert p.counts()[category] == 2
+
+
+def test_sync():
+    d, e = daco_client()
+    issues = d.sync()
+    counts, errors = d.get_summary()
+
+    d2, _ = daco_client()
+    assert set(issues) == set(d2.update_ego())
+    assert counts == d2.get_summary()[0]
+    assert errors == []
+
+    calls = e.get_calls()
+    # one snapshot of ego, and no per user questions
+    assert calls['all_users'] == [None]
+    assert calls['get_users'] == ['daco', 'cloud']
+    assert 'is_member' not in calls and 'user_exists' not in calls
+    assert calls['create_user'] == [('d@ca', 'Person D'), ('e@ca', 'Person E')]
+
+
+def test_sync_errors():
+    d, e = daco_client(success=False)
+    issues = d.sync()
+    assert issues == ["Error: Can't get the current state of ego -- "
+                      "MockEgoException(all_users())"]
+
+
+def batched_client(success=True):
+    d, e = daco_client(success)
+    d.batch_size = 2
+    return d, e
+
+
+def test_sync_batched():
+    d, e = batched_client()
+    issues = d.sync()
+
+    d2, _ = daco_client()
+    assert issues == d2.sync()
+    assert d.get_summary() == d2.get_summary()
+    assert e.batches == [('add', 'daco', 2), ('add', 'daco', 2),
+                         ('add', 'cloud', 2), ('add', 'cloud', 1),
+                         ('remove', 'daco', 2),
+                         ('remove', 'cloud', 2), ('remove', 'cloud', 2)]
+
+
+def test_batch_failure_falls_back_to_single_users():
+    d, e = batched_client()
+    add = e.add
+
+    def add_except_b(group, users):
+        if 'b@ca' in users:
+            raise IOError("Can't add b@ca")
+        add(group, users)
+
+    e.add = add_except_b
+    issues = d.sync()
+
+    assert "Error: Can't grant cloud access to user 'b@ca(Person Bee)' -- " \
+           "OSError(Can't add b@ca)" in issues
+    assert "Granted daco and cloud to existing user 'aa@ca(Person A)'" in issues
+    # aa@ca, from b's batch, was added on its own; then e@ca's batch
+    assert e.batches[2:4] == [('add', 'cloud', 1), ('add', 'cloud', 1)]
+    assert e.get_calls()['add'][-2:] == [('cloud', 'aa@ca'), ('cloud', 'e@ca')]
+
+    counts, errors = d.get_summary()
+    assert 'grant_cloud' not in counts
+    assert counts['grant_both'] == 1
+    assert errors == ["*Error:* Ego operation *grant cloud access* failed for 1 users"]
+
+
+def test_request_count():
+    p = plan()
+    # 2 creates, then 4 + 3 adds and 2 + 4 removes
+    assert p.request_count() == 2 + 4 + 3 + 2 + 4
+    assert p.request_count(2) == 2 + 2 + 2 + 1 + 2
+    assert p.request_count(100) == 2 + 4
+
+
+def test_plan_report():
+    text = create_plan(plan(), 15, 0.2)
+    assert "*Create* (2):\n\td@ca\n\te@ca\n" in text
+    assert "*Revoke DACO* (2):\n\ti@ca\n\tj@ca\n" in text
+    assert "Added 2 users(1 with DACO access, 1 with DACO & Cloud)." in text
+    assert text.endswith("*Estimate*: 15 ego requests, about 3 seconds "
+                         "(at 200ms per request)\n")
+    assert create_plan(Plan(), 0, None).endswith("*Estimate*: 0 ego requests\n")
+    assert create_plan(plan(), 15, 0.2, 4).endswith("*Estimate*: 15 ego requests, about 1 seconds "
+                                                    "(at 200ms per request, 4 at a time)\n")
+
+
+def test_show_plan(capsys):
+    d, e = daco_client()
+    show_plan(d)
+    out = capsys.readouterr().out
+    assert out.startswith("*Daco2Ego Plan*")
+    assert "15 ego requests, about 4 seconds" in out
+    assert set(e.get_calls()) == {'all_users', 'get_users'}
+
+
+def test_show_plan_errors(capsys):
+    def export():
+        yield from users
+        raise IOError("the export stopped")
+
+    _, e = daco_client()
+    show_plan(DacoClient(daco_group, cloud_group, export(), e))
+    assert capsys.readouterr().out.startswith("Error: Can't make a plan -- ")
+
+
+def test_plan_never_reports_to_slack(monkeypatch, capsys):
+    sent = []
+
+    class Reporter(object):
+        def __init__(self, url, transport):
+            pass
+
+        def send(self, report):
+            sent.append(report)
+
+    def init(*args):
+        raise IOError("ego is down")
+
+    monkeypatch.setattr(daco2ego, 'read_config', lambda path: {'client': {}, 'slack': {'url': ''}})
+    monkeypatch.setattr(daco2ego, 'SlackReporter', Reporter)
+    monkeypatch.setattr(daco2ego, 'init', init)
+    daco2ego.main("daco2ego.py", "--plan")
+    assert sent == []
+    assert "DACO client init error" in capsys.readouterr().out
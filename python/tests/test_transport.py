@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+import json
+import threading
+import time
+
+from requests import Response
+from requests.adapters import BaseAdapter
+
+from ego_client import EgoClient
+from rate_limit import AdaptiveLimiter
+from slack import Reporter
+from token_cache import TokenCache
+from transport import Transport
+
+base_url = "https://ego/v1"
+
+
+class FakeEgoAdapter(BaseAdapter):
+    """ Answers requests for https://ego without going over the network """
+
+    def __init__(self):
+        super(FakeEgoAdapter, self).__init__()
+        self.requests = []
+        self.timeouts = []
+        self.tokens = 0
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        self.timeouts.append(kwargs.get('timeout'))
+        if request.url.endswith('/oauth/token'):
+            self.tokens += 1
+            body = {"access_token": f"token{self.tokens}", "token_type": "bearer",
+                    "expires_in": 3600}
+        else:
+            body = {"count": 1, "resultSet": [{"id": "g1", "name": "daco"}],
+                    "authorization": request.headers.get('Authorization')}
+        r = Response()
+        r.status_code = 200
+        r.url = request.url
+        r.request = request
+        r._content = json.dumps(body).encode()
+        return r
+
+    def close(self):
+        pass
+
+
+def transport():
+    t = Transport()
+    adapter = FakeEgoAdapter()
+    t.session.mount("https://ego", adapter)
+    return t, adapter
+
+
+def test_requests_carry_the_token():
+    t, adapter = transport()
+    auth = t.client_credentials(base_url + "/oauth/token", "daco2ego", "secret")
+    client = t.client(auth)
+
+    r = client.get(base_url + "/groups?name=daco")
+    assert r.json()['authorization'] == "Bearer token1"
+    assert adapter.requests[0].headers['Authorization'].startswith("Basic ")
+    assert t.metrics.count('http POST ego') == 1 and t.metrics.count('http GET ego') == 1
+
+
+def test_token_refreshed_in_place():
+    t, adapter = transport()
+    rest_client = t.client(t.client_credentials(base_url + "/oauth/token",
+                                                "daco2ego", "secret"))
+    ego = EgoClient(base_url, rest_client, rest_client.refreshed)
+
+    rest_client.auth._client._expires_at = time.time() - 1
+    assert ego._get_json("/groups?name=daco")['authorization'] == "Bearer token2"
+
+    # same client, same session: the pooled connections are kept
+    assert ego._rest_client is rest_client
+    assert adapter.tokens == 2
+
+
+def test_token_refreshed_before_it_expires():
+    t, adapter = transport()
+    rest_client = t.client(t.client_credentials(base_url + "/oauth/token",
+                                                "daco2ego", "secret"))
+    ego = EgoClient(base_url, rest_client)  # no factory: an expired token would raise
+
+    rest_client.auth.token['expires_at'] = time.time() + 30  # inside the margin
+    assert ego._get_json("/groups?name=daco")['authorization'] == "Bearer token2"
+    assert ego._get_json("/groups?name=daco")['authorization'] == "Bearer token2"
+    assert adapter.tokens == 2
+
+
+def test_token_refresh_with_one_slot():
+    # the token request mustn't wait for the slot of the request it's for
+    t, adapter = transport()
+    t.limiter = AdaptiveLimiter(1)
+    rest_client = t.client(t.client_credentials(base_url + "/oauth/token",
+                                                "daco2ego", "secret"))
+    rest_client.auth.token['expires_at'] = time.time() + 30  # inside the margin
+
+    result = []
+    thread = threading.Thread(target=lambda: result.append(rest_client.get(base_url + "/groups")),
+                              daemon=True)
+    thread.start()
+    thread.join(5)
+    assert result and result[0].json()['authorization'] == "Bearer token2"
+    assert t.limiter.in_flight == 0
+
+
+def test_token_cache(tmpdir):
+    path = str(tmpdir.join("tokens"))
+    cache = TokenCache(path, "key")
+    assert cache.get("ego") is None
+    cache.put("ego", {"access_token": "abc"})
+    assert TokenCache(path, "key").get("ego") == {"access_token": "abc"}
+    assert b"abc" not in open(path, "rb").read()
+
+    # the wrong key, or a damaged file, is the same as no cache
+    assert TokenCache(path, "other key").get("ego") is None
+    with open(path, "wb") as f:
+        f.write(b"not a token cache")
+    assert TokenCache(path, "key").get("ego") is None
+
+
+def test_cached_token_reused(tmpdir):
+    cache = TokenCache(str(tmpdir.join("tokens")), "key")
+    t, adapter = transport()
+    t.token_cache = cache
+    t.client_credentials(base_url + "/oauth/token", "daco2ego", "secret")
+
+    t2, adapter2 = transport()
+    t2.token_cache = cache
+    client = t2.client(t2.client_credentials(base_url + "/oauth/token",
+                                             "daco2ego", "secret"))
+    assert client.get(base_url + "/groups?name=daco").json()['authorization'] == "Bearer token1"
+    assert adapter2.tokens == 0
+
+    # a token about to expire isn't reused
+    t2.refresh_margin = 7200
+    t2.client_credentials(base_url + "/oauth/token", "daco2ego", "secret")
+    assert adapter2.tokens == 1
+
+
+def test_slack_reports_go_through_the_transport():
+    t, adapter = transport()
+    Reporter(base_url + "/slack", t).send("a <report>")
+    request = adapter.requests[0]
+    assert json.loads(request.body)['text'] == "a &lt;report&gt;"
+    assert request.headers['User-Agent'] == 'daco2ego'
+    assert adapter.timeouts == [t.timeout]
+    assert t.metrics.count('http POST ego') == 1
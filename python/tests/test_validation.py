@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+from daco_user import User
+from tests.test_daco_client import daco_client, users
+from validation import INVALID, INVALID_EMAIL, MULTIPLE_ENTRIES, validate
+
+
+def test_validate():
+    rejects = validate(users)
+    assert len(rejects) == 3
+    assert rejects.reason(2) == MULTIPLE_ENTRIES  # b@ca, replaced by a later entry
+    assert rejects.reason(3) is None  # the later b@ca entry
+    assert rejects.reason(4) == INVALID  # cloud without daco
+    assert rejects.reason(10) == INVALID_EMAIL
+    assert 0 not in rejects and 2 in rejects
+    assert rejects.duplicates == 1
+    assert rejects.counts() == {MULTIPLE_ENTRIES: 1, INVALID: 1, INVALID_EMAIL: 1}
+
+
+def test_repeats_are_not_duplicates():
+    a = User('a@ca', 'Person A', True, True)
+    a2 = User('A@CA', 'Person A2', True, True)
+    rejects = validate([a, a, a2, a2])
+    assert [rejects.reason(i) for i in range(4)] == [MULTIPLE_ENTRIES, MULTIPLE_ENTRIES, None, None]
+    assert rejects.duplicates == 1
+
+
+def test_rejects_reported_without_asking_ego():
+    d, e = daco_client()
+    issues = list(d.grant())
+    assert "Warning: User 'b@ca(Person B)' has multiple entries in the daco file!" in issues
+    assert "Warning: User 'c@ca(Person C)' is invalid (in cloud file, but not in DACO)" in issues
+    # ego is only asked about the entries that passed
+    assert e.get_calls()['user_exists'] == ['a@ca', 'aa@ca', 'b@ca', 'd@ca', 'e@ca',
+                                            'f@ca', 'g@ca', 'h@ca']
@@ -0,0 +1,71 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+
+class TokenCache(object):
+    """
+    Keeps OAuth tokens in an encrypted file, so that runs started close
+    together (back to back, or shards of one run) can share a token
+    instead of each asking ego for a new one.
+
+    The file is encrypted with AES-GCM, using a key derived from the given
+    secret, so needs pycryptodome; without it, the cache does nothing.
+    """
+
+    def __init__(self, path, secret):
+        self.path = path
+        self._key = hashlib.sha256(secret.encode()).digest()
+        self._lock = threading.Lock()
+        try:
+            from Crypto.Cipher import AES
+            self._aes = AES
+        except ImportError:
+            logging.warning("pycryptodome isn't installed; not caching tokens.")
+            self._aes = None
+
+    def _read(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return {}
+        try:
+            nonce, tag, ciphertext = data[:16], data[16:32], data[32:]
+            cipher = self._aes.new(self._key, self._aes.MODE_GCM, nonce=nonce)
+            return json.loads(cipher.decrypt_and_verify(ciphertext, tag))
+        except (ValueError, KeyError) as e:
+            logging.warning(f"Ignoring unreadable token cache {self.path}: {e}")
+            return {}
+
+    def _write(self, tokens):
+        cipher = self._aes.new(self._key, self._aes.MODE_GCM)
+        ciphertext, tag = cipher.encrypt_and_digest(json.dumps(tokens).encode())
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(cipher.nonce + tag + ciphertext)
+        os.replace(tmp, self.path)
+
+    def get(self, name):
+        """
+        :param name: Which token we want (e.g. the token url and client id)
+        :return: The token we saved under name, or None
+        """
+        if self._aes is None:
+            return None
+        with self._lock:
+            return self._read().get(name)
+
+    def put(self, name, token):
+        if self._aes is None:
+            return
+        with self._lock:
+            try:
+                tokens = self._read()
+                tokens[name] = token
+                self._write(tokens)
+            except OSError as e:
+                logging.warning(f"Can't save token cache {self.path}: {e}")
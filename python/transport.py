@@ -0,0 +1,267 @@
+import logging
+import threading
+import time
+from urllib.parse import urlparse
+
+from oauthlib.common import urldecode
+from oauthlib.oauth2 import BackendApplicationClient, TokenExpiredError
+from requests import ConnectionError, Session, Timeout
+from requests.adapters import HTTPAdapter
+from requests.auth import AuthBase, HTTPBasicAuth
+
+from metrics import Metrics, endpoint_name
+from rate_limit import AdaptiveLimiter, RETRY_STATUSES, backoff, retry_after
+
+# Requests we can safely send again if we aren't sure ego got them
+IDEMPOTENT = frozenset(['GET', 'HEAD'])
+
+
+def retry_oauth(func):
+    """
+    Decorator for methods making rest requests
+    Retry the request if encountering a TokenExpiredError by generating a new rest client with a new OAuth2 Bearer Token
+    :param func: function to decorate
+    :return: decorated function
+    """
+
+    def func_wrapper(self, *args, **kwargs):
+        seen = (self._rest_client, getattr(self._rest_client, 'token', None))
+        try:
+            return func(self, *args, **kwargs)
+        except TokenExpiredError as e:
+            if self._rest_client_factory is None:
+                raise e
+            with self._token_lock:
+                # Other threads may have seen the same expired token;
+                # only the first one through needs to get a new one.
+                if (self._rest_client, getattr(self._rest_client, 'token', None)) == seen:
+                    logging.info('Token expired for Daco2Ego, requesting new authorization.')
+                    self._rest_client = self._rest_client_factory()
+            return func(self, *args, **kwargs)
+
+    return func_wrapper
+
+
+class ClientCredentials(AuthBase):
+    """
+    OAuth2 client credentials for one ego instance.
+
+    Adds the bearer token to each request. A token that will expire
+    within refresh_margin seconds is replaced before the request goes
+    out, so requests shouldn't fail on an expired token; if one does, we
+    raise TokenExpiredError (as OAuth2Session does) and refresh() gets a
+    new token in place, keeping the connections we've already opened.
+    If we have a TokenCache, tokens are shared through it.
+    """
+
+    def __init__(self, transport, token_url, client_id, client_secret,
+                 refresh_margin=60, cache=None):
+        self.transport = transport
+        self.token_url = token_url
+        self.client_id = client_id
+        self.refresh_margin = refresh_margin
+        self._secret = client_secret
+        self._cache = cache
+        self._client = BackendApplicationClient(client_id=client_id)
+        self._lock = threading.Lock()
+
+    @property
+    def token(self):
+        return getattr(self._client, 'token', None)
+
+    def _cache_name(self):
+        return f"{self.token_url} {self.client_id}"
+
+    def _expires_soon(self, token):
+        expires_at = (token or {}).get('expires_at')
+        return expires_at is not None and expires_at - self.refresh_margin < time.time()
+
+    def _use(self, token):
+        self._client.token = token
+        self._client.populate_token_attributes(token)
+        self._client._expires_at = token.get('expires_at')
+
+    def load_cached(self):
+        """
+        Use the token in our cache, if there's one that isn't about to expire
+        :return: True if we found one
+        """
+        if self._cache is None:
+            return False
+        token = self._cache.get(self._cache_name())
+        if not token or self._expires_soon(token):
+            return False
+        with self._lock:
+            self._use(token)
+        return True
+
+    def refresh(self, stale=None):
+        """
+        Get a new token
+        :param stale: If given, only get a new token if our token is still this one
+        :return: The new token
+        """
+        with self._lock:
+            if stale is not None and self.token is not stale:
+                return self.token  # someone else has already replaced it
+            body = self._client.prepare_request_body()
+            r = self.transport.request('POST', self.token_url, data=dict(urldecode(body)),
+                                       headers={'Accept': 'application/json'},
+                                       auth=HTTPBasicAuth(self.client_id, self._secret))
+            if not r.ok:
+                raise IOError(f"Error requesting a token from {self.token_url}", r)
+            self._client.parse_request_body_response(r.text)
+            token = self.token
+        if self._cache is not None:
+            self._cache.put(self._cache_name(), token)
+        return token
+
+    def ensure_fresh(self):
+        """
+        Replace our token if it's about to expire. This has to happen
+        before a request takes a slot from the limiter, not in __call__:
+        the token request needs a slot of its own, and with a limit of
+        one it would wait for ours forever.
+        """
+        token = self.token
+        if self._expires_soon(token):
+            logging.info(f"Token for {self.token_url} is about to expire, requesting a new one.")
+            self.refresh(stale=token)
+
+    def __call__(self, r):
+        r.url, headers, _ = self._client.add_token(r.url, http_method=r.method)
+        r.headers.update(headers)
+        return r
+
+
+class TransportClient(object):
+    """
+    A rest client, with the get/post/delete methods our ego clients use,
+    that sends its requests through a shared Transport with its own auth.
+    """
+
+    def __init__(self, transport, auth=None):
+        self.transport = transport
+        self.auth = auth
+        self.stream = False
+
+    @property
+    def token(self):
+        return self.auth.token if self.auth is not None else None
+
+    def refreshed(self):
+        """
+        Get a new token, and return ourselves; this is the rest client
+        factory to give to EgoClient and DacoV2EgoClient.
+        """
+        self.auth.refresh()
+        return self
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('stream', self.stream)
+        if self.auth is not None:
+            self.auth.ensure_fresh()
+        return self.transport.request(method, url, auth=self.auth, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+
+class Transport(object):
+    """
+    The one HTTP session that all of our outbound requests go through,
+    so that every client shares its pool of kept-alive connections, and
+    so that timeouts, headers and request statistics live in one place.
+
+    :param pool_size: How many connections to keep open to each host;
+        this should be at least how many requests we make at once.
+    :param timeout: How many seconds to wait for a server before giving up
+    :param token_cache: A TokenCache to share OAuth tokens through
+    :param refresh_margin: How many seconds before a token expires to replace it
+    :param limiter: An AdaptiveLimiter for how many requests to send at once
+        (by default, up to pool_size)
+    :param retries: How many times to retry a request that ego turned away
+        with a 429 or 5xx, or a read that failed to connect
+    :param metrics: The Metrics to record each request (and each retry) in,
+        by host
+    """
+
+    def __init__(self, pool_size=10, timeout=60, token_cache=None,
+                 refresh_margin=60, limiter=None, retries=3, sleep=time.sleep,
+                 metrics=None):
+        self.timeout = timeout
+        self.token_cache = token_cache
+        self.refresh_margin = refresh_margin
+        self.limiter = limiter if limiter is not None else AdaptiveLimiter(pool_size)
+        self.retries = retries
+        self._sleep = sleep
+        self.session = Session()
+        self.session.headers['User-Agent'] = 'daco2ego'
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.metrics = metrics if metrics is not None else Metrics()
+
+    def client_credentials(self, token_url, client_id, client_secret):
+        """
+        :return: A ClientCredentials auth, with a token already fetched
+                 (or found in our token cache)
+        """
+        auth = ClientCredentials(self, token_url, client_id, client_secret,
+                                 self.refresh_margin, self.token_cache)
+        if not auth.load_cached():
+            auth.refresh()
+        return auth
+
+    def client(self, auth=None):
+        return TransportClient(self, auth)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            try:
+                r = self._send(method, url, **kwargs)
+            except (ConnectionError, Timeout) as e:
+                if method not in IDEMPOTENT or attempt >= self.retries:
+                    raise
+                logging.warning(f"{method} {url} failed ({e}), retrying.")
+                wait = backoff(attempt)
+            else:
+                if not self._should_retry(method, r, attempt):
+                    return r
+                wait = retry_after(r)
+                if wait is None:
+                    wait = backoff(attempt)
+                else:
+                    self.limiter.pause(wait)
+                logging.warning(f"{method} {url} returned {r.status_code}, "
+                                f"retrying in {wait:.1f}s.")
+                r.close()
+            self._sleep(wait)
+            attempt += 1
+
+    def _should_retry(self, method, r, attempt):
+        if attempt >= self.retries or r.status_code not in RETRY_STATUSES:
+            return False
+        # ego doesn't act on a request it turns away with a 429
+        return method in IDEMPOTENT or r.status_code == 429
+
+    def _send(self, method, url, **kwargs):
+        self.limiter.acquire()
+        start = time.monotonic()
+        overloaded = True
+        try:
+            with self.metrics.timer(endpoint_name('http', method, urlparse(url).netloc)) as request:
+                r = self.session.request(method, url, **kwargs)
+                request['error'] = not r.ok
+                overloaded = r.status_code in RETRY_STATUSES
+            return r
+        finally:
+            self.limiter.release(time.monotonic() - start, overloaded)
@@ -0,0 +1,85 @@
+from collections import Counter
+
+from daco_user import email_key
+
+# Why we might not act on an entry of the approved users list
+MULTIPLE_ENTRIES = 'multiple_entries'
+INVALID_EMAIL = 'invalid_email'
+INVALID = 'invalid'
+
+WARNINGS = {
+    MULTIPLE_ENTRIES: "Warning: User '{}' has multiple entries in the daco file!",
+    INVALID_EMAIL: "Warning: User '{}' does not have a valid email address",
+    INVALID: "Warning: User '{}' is invalid (in cloud file, but not in DACO)",
+}
+
+
+def warning(user, reason):
+    return WARNINGS[reason].format(user)
+
+
+def check(user, latest):
+    """
+    The checks we can make on one entry without asking ego
+    :param user: An entry from the approved users list
+    :param latest: The last entry in the list with the same email
+    :return: Why we shouldn't act on the entry, or None if we should
+    """
+    if latest != user:
+        return MULTIPLE_ENTRIES
+    if user.invalid_email():
+        return INVALID_EMAIL
+    if user.is_invalid():
+        return INVALID
+    return None
+
+
+class Rejects(object):
+    """
+    The entries of an approved users list that we won't grant anything
+    to, by their position in the list, with the reason for each.
+
+    :param reasons: A dictionary of position to reason
+    :param duplicates: How many emails have more than one (different) entry
+    """
+
+    def __init__(self, reasons, duplicates=0):
+        self._reasons = reasons
+        self.duplicates = duplicates
+
+    def __contains__(self, position):
+        return position in self._reasons
+
+    def __len__(self):
+        return len(self._reasons)
+
+    def reason(self, position):
+        return self._reasons.get(position)
+
+    def counts(self):
+        return dict(Counter(self._reasons.values()))
+
+
+def validate(users):
+    """
+    Check every entry of the approved users list, once, before we do any
+    work in ego: count the entries for each email to find the duplicates,
+    then check the rest for invalid emails and inconsistent access.
+
+    The last entry for an email is the one that counts; an earlier entry
+    that's the same as it isn't a duplicate, just a repeat.
+
+    :param users: The approved users, as a list of User objects
+    :return: Rejects
+    """
+    entries = Counter(email_key(u.email) for u in users)
+    latest = {email_key(u.email): u for u in users if entries[email_key(u.email)] > 1}
+
+    reasons = {}
+    for position, user in enumerate(users):
+        reason = check(user, latest.get(email_key(user.email), user))
+        if reason is not None:
+            reasons[position] = reason
+
+    duplicates = len({email_key(users[p].email) for p, r in reasons.items() if r == MULTIPLE_ENTRIES})
+    return Rejects(reasons, duplicates)